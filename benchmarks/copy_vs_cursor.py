@@ -0,0 +1,79 @@
+"""Compare the throughput of the extraction engines on a live database.
+
+Engines can be suffixed with a type conversion profile (e.g. cursor+raw) to
+compare the profiles with each other.
+
+Usage:
+    python benchmarks/copy_vs_cursor.py --host localhost --port 5432 \\
+        --db-name mydb --username user --password pass public.big_table
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from postgresv2.postgresv2 import Postgres  # noqa: E402
+
+OPTIONS = {
+    "logger": lambda *msgs: None,  # no-op logger
+}
+
+
+def run(source: dict, engine: str, batch_size: int) -> tuple:
+    """read all the tables of the source, return (rows, seconds). `engine` is
+    the name of the engine, optionally followed by the COPY format (e.g.
+    copy:binary) and the type profile (e.g. cursor+raw)"""
+    engine, _, type_profile = engine.partition('+')
+    engine, _, copy_format = engine.partition(':')
+    inst = Postgres(dict(source, __engine=engine,
+                         __copyFormat=copy_format or 'text',
+                         __typeProfile=type_profile or 'default'), OPTIONS)
+    rows = 0
+    start = time.perf_counter()
+    batch = inst.read(batch_size)
+    while batch is not None:
+        rows += len(batch)
+        batch = inst.read(batch_size)
+
+    return rows, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('tables', nargs='+', help='schema.table to read')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--db-name', required=True)
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--engines', nargs='+',
+                        default=['cursor', 'copy', 'copy:binary'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    source = {
+        'host': args.host,
+        'port': args.port,
+        'db_name': args.db_name,
+        'username': args.username,
+        'password': args.password,
+        'data_available': [{'value': t} for t in args.tables],
+    }
+
+    baseline = None
+    for engine in args.engines:
+        # best of n, to leave the cache warm-up out
+        rows, elapsed = min((run(source, engine, args.batch_size)
+                             for _ in range(args.repeat)),
+                            key=lambda r: r[1])
+        rate = rows / elapsed if elapsed else 0
+        baseline = baseline or rate
+        print('{:<16} {:>10} rows {:>8.2f}s {:>12,.0f} rows/s {:>6.2f}x'
+              .format(engine, rows, elapsed, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Benchmark `Postgres.read()` against a fake database, no server required.
+
+Tables are generated with the given number of rows and columns (cycling
+through the given types) and served by a fake psycopg2 connection. Every
+engine is run in turn, measuring its throughput, the latency of each batch and
+the peak memory allocated while reading. The work of the fake connection is
+included in the numbers, so they're meant for comparing changes to the
+connector with each other rather than with a real database.
+
+Usage:
+    python benchmarks/offline.py --rows 200000 --width 12
+    python benchmarks/offline.py --save        # store the results as baseline
+    python benchmarks/offline.py --check       # fail on regressions
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+import mock
+import psycopg2.extras
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from postgresv2.postgresv2 import Postgres  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+ENGINES = ['cursor', 'cursor:tuple', 'cursor:columnar', 'copy', 'keyset']
+TYPES = ['int', 'float', 'text', 'timestamp', 'numeric', 'bool', 'json']
+BLOCK_SIZE = 1000  # distinct rows generated, repeated over the table
+
+OPTIONS = {
+    "logger": lambda *msgs: None,  # no-op logger
+}
+
+# a value of each type out of a number, and its OID
+GENERATORS = {
+    'int': (lambda i: i * 7, 23),
+    'float': (lambda i: i / 3, 701),
+    'text': (lambda i: 'value number {}'.format(i), 25),
+    'timestamp': (lambda i: datetime.datetime(2020, 1, 1) +
+                  datetime.timedelta(seconds=i), 1114),
+    'numeric': (lambda i: Decimal(i) / 100, 1700),
+    'bool': (lambda i: i % 2 == 0, 16),
+    'json': (lambda i: {'key': i, 'tags': ['a', 'b']}, 3802),
+}
+
+
+def to_copy_text(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return str(value)
+
+
+class FakeTable:
+    """A synthetic table of `rows` rows, with an `id` column followed by
+    `width - 1` columns of the given types"""
+
+    def __init__(self, rows: int, width: int, types: list):
+        self.count = rows
+        kinds = [types[i % len(types)] for i in range(width - 1)]
+        self.columns = ['id'] + ['c{}_{}'.format(i, k)
+                                 for i, k in enumerate(kinds)]
+        self.oids = [20] + [GENERATORS[k][1] for k in kinds]
+        self.block = [tuple(GENERATORS[k][0](i) for k in kinds)
+                      for i in range(BLOCK_SIZE)]
+        self.copy_block = ['\t'.join(map(to_copy_text, values))
+                           for values in self.block]
+
+    def rows(self, start: int, stop: int):
+        """(id, values) of the rows from `start` to `stop`"""
+        block = self.block
+        for i in range(start, min(stop, self.count)):
+            yield i + 1, block[i % BLOCK_SIZE]
+
+
+class FakeCursor:
+    """Answers the queries `Postgres` sends for the cursor, copy and keyset
+    engines"""
+
+    def __init__(self, table: FakeTable, dicts: bool):
+        self.table = table
+        self.dicts = dicts
+        self.description = None
+        self.result = []
+        self.position = 0
+
+    def execute(self, query: str, params: list = None):
+        table = self.table
+        self.description = [(c, oid) for c, oid in
+                            zip(table.columns, table.oids)]
+        self.result = []
+        if query.startswith('DECLARE'):
+            self.position = 0
+        elif query.startswith('FETCH FORWARD'):
+            size = int(query.split()[2])
+            self.result = self._rows(self.position, self.position + size)
+            self.position += size
+        elif 'pg_index' in query:
+            self.result = [{'column': 'id'}]
+        elif query.startswith('EXECUTE'):
+            after = params[0] if len(params) > 1 else 0
+            self.result = self._rows(int(after), int(after) + params[-1])
+
+    def _rows(self, start: int, stop: int) -> list:
+        columns = self.table.columns
+        if self.dicts:
+            return [dict(zip(columns, (i,) + values))
+                    for i, values in self.table.rows(start, stop)]
+        return [(i,) + values for i, values in self.table.rows(start, stop)]
+
+    def fetchall(self) -> list:
+        return self.result
+
+    def copy_expert(self, query: str, file, size: int = 65536):
+        chunk = []
+        length = 0
+        block = self.table.copy_block
+        for i in range(self.table.count):
+            line = '{}\t{}\n'.format(i + 1, block[i % BLOCK_SIZE])
+            chunk.append(line)
+            length += len(line)
+            if length >= size:
+                file.write(''.join(chunk).encode())
+                chunk = []
+                length = 0
+        if chunk:
+            file.write(''.join(chunk).encode())
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    encoding = 'UTF8'
+    closed = 0
+
+    def __init__(self, table: FakeTable):
+        self.table = table
+
+    def cursor(self, cursor_factory=None):
+        dicts = cursor_factory is psycopg2.extras.RealDictCursor
+        return FakeCursor(self.table, dicts)
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def get_source(engine: str, batch_size: int) -> dict:
+    engine, _, row_format = engine.partition(':')
+    return {
+        'host': 'localhost',
+        'port': '5432',
+        'db_name': 'bench',
+        'username': 'bench',
+        'password': 'bench',
+        'data_available': [{'value': 'public.bench'}],
+        '__engine': engine,
+        '__rowFormat': row_format or 'dict',
+        '__batchSize': batch_size,
+    }
+
+
+def run(table: FakeTable, engine: str, batch_size: int,
+        trace: bool = False) -> dict:
+    """read the whole table with the engine, return its measurements. The
+    peak memory is only traced when `trace` is set, as tracing slows down
+    everything else"""
+    connection = FakeConnection(table)
+    with mock.patch('psycopg2.connect', return_value=connection):
+        inst = Postgres(get_source(engine, batch_size), OPTIONS)
+        latencies = []
+        rows = 0
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        while True:
+            batch_start = time.perf_counter()
+            batch = inst.read()
+            if batch is None:
+                break
+            latencies.append(time.perf_counter() - batch_start)
+            rows += len(batch)
+        elapsed = time.perf_counter() - start
+        peak = 0
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    if rows != table.count:
+        raise AssertionError('{} read {} rows out of {}'.format(
+            engine, rows, table.count))
+
+    latencies = sorted(latencies)
+    return {
+        'rows_per_s': rows / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+        'peak_mb': peak / 2 ** 20,
+    }
+
+
+def get_regressions(results: dict, baseline: dict,
+                    tolerance: float) -> list:
+    """return the descriptions of the results worse than the baseline by
+    more than `tolerance` (a fraction)"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['rows_per_s'] < base['rows_per_s'] * (1 - tolerance):
+            regressions.append('{}: {:,.0f} rows/s, baseline {:,.0f}'.format(
+                name, result['rows_per_s'], base['rows_per_s']))
+        if result['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            regressions.append('{}: {:.1f} MB peak, baseline {:.1f}'.format(
+                name, result['peak_mb'], base['peak_mb']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--width', type=int, default=10,
+                        help='number of columns, including the id')
+    parser.add_argument('--types', nargs='+', default=TYPES, choices=TYPES)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--engines', nargs='+', default=ENGINES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with an error on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    table = FakeTable(args.rows, args.width, args.types)
+    results = {}
+    for engine in args.engines:
+        # best of n, to leave the warm-up out
+        runs = [run(table, engine, args.batch_size)
+                for _ in range(args.repeat)]
+        result = max(runs, key=lambda r: r['rows_per_s'])
+        result['peak_mb'] = run(table, engine, args.batch_size,
+                                trace=True)['peak_mb']
+        name = '{}/{}x{}'.format(engine, args.rows, args.width)
+        results[name] = result
+        print('{:<26} {:>12,.0f} rows/s  p50 {:>7.2f}ms  p95 {:>7.2f}ms  '
+              'peak {:>7.1f}MB'.format(name, result['rows_per_s'],
+                                       result['p50_ms'], result['p95_ms'],
+                                       result['peak_mb']))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = get_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+
+    if args.save:
+        baseline.update({name: {k: round(v, 2) for k, v in result.items()}
+                         for name, result in results.items()})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
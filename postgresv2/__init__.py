@@ -1,2 +1,4 @@
 from .configuration import CONFIG
 from .postgresv2 import Postgres as Stream
+from .aio import AsyncPostgres as AsyncStream
+from .scheduler import Scheduler
@@ -0,0 +1,267 @@
+import asyncio
+import time
+from typing import Dict, List
+
+import backoff
+import panoply
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from .batch import Batch, ColumnBatch
+from .dal.connector import Connector
+from .dal.queries.consts import CONNECT_TIMEOUT, MAX_RETRIES
+from .dal.queries.query_builder import get_query, get_max_value_query, \
+    get_columns_query, get_index_query
+from .dynamic_params import get_tables_request, get_cached_tables, \
+    cache_tables
+from .exceptions import PostgresInckeyError, PostgresValidationError
+from .postgresv2 import Postgres, _log_backoff, _get_connect_timeout
+from .utils import format_table_name, get_dsn, register_types, reset, \
+    validate_host_and_port
+
+# options of `Postgres` which the async stream doesn't support
+UNSUPPORTED_OPTIONS = ('__replicationSlot', '__xminSync', '__tableOrder',
+                       '__splitMode', '__prefetch', '__reuseConnections',
+                       '__consistentSnapshot', '__spool')
+
+
+async def wait(connection: object):
+    """wait for the pending operation of an async connection, without
+    blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(
+                'Unexpected poll state {}'.format(state))
+
+        ready = loop.create_future()
+        fileno = connection.fileno()
+        add(fileno, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fileno)
+
+
+async def connect(source: Dict) -> Connector:
+    """connect to the DB in psycopg2's async mode"""
+    try:
+        conn = psycopg2.connect(
+            dsn=get_dsn(source),
+            user=source['username'],
+            password=source['password'],
+            connect_timeout=CONNECT_TIMEOUT,
+            async_=1
+        )
+        try:
+            # libpq doesn't time out connections in async mode by itself
+            await asyncio.wait_for(wait(conn), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            conn.close()
+            raise psycopg2.OperationalError(
+                'Connection timed out after {} seconds'.format(
+                    CONNECT_TIMEOUT))
+        register_types(conn, source)
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    except psycopg2.OperationalError as e:
+        if 'authentication failed' in str(e):
+            e = panoply.PanoplyException(
+                "Login failed for user: {}".format(source['username']),
+                retryable=False
+            )
+        raise e
+
+    return Connector(connection=conn, cursor=cur)
+
+
+def close_connection(connector: Connector):
+    """close an async connection, there's no transaction to roll back as it
+    is closed along with the connection"""
+    try:
+        if connector.cursor:
+            connector.cursor.close()
+        if connector.connection:
+            connector.connection.close()
+    except psycopg2.InterfaceError:
+        pass
+    finally:
+        reset(connector)
+
+
+async def execute(connector: Connector, query: str, cursor: object = None,
+                  params: list = None):
+    cursor = cursor or connector.cursor
+    cursor.execute(query, params)
+    await wait(connector.connection)
+
+
+async def get_tables(source: Dict) -> List[Dict]:
+    """same as `dynamic_params.get_tables`, over an async connection"""
+    validate_host_and_port(source)
+    key, query = get_tables_request(source)
+    cached = get_cached_tables(key)
+    if cached is not None:
+        return cached
+
+    connector = await connect(source)
+    try:
+        await execute(connector, query[0], params=query[1])
+        result = list(map(format_table_name, connector.cursor.fetchall()))
+    finally:
+        close_connection(connector)
+
+    return cache_tables(key, result)
+
+
+class AsyncPostgres(Postgres):
+    """An asyncio counterpart of the `Postgres` stream, reading the tables
+    with the cursor engine over a connection in psycopg2's async mode, so
+    that a single event loop can drive many streams at once.
+
+    `read` is a coroutine with the same results and state as `Postgres.read`,
+    and the non empty batches can be iterated with `async for`."""
+
+    def __init__(self, source: dict, options: dict):
+        super(AsyncPostgres, self).__init__(source, options)
+        unsupported = [o for o in UNSUPPORTED_OPTIONS if source.get(o)]
+        if self.engine != 'cursor':
+            unsupported.append('__engine')
+        if self.concurrency > 1:
+            unsupported.append('__concurrency')
+        if unsupported:
+            raise PostgresValidationError(
+                'Not supported by the async stream: {}'.format(
+                    ', '.join(unsupported)))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> (list, Batch, ColumnBatch):
+        while True:
+            batch = await self.read()
+            if batch is None:
+                raise StopAsyncIteration
+            if batch:
+                return batch
+
+    @backoff.on_exception(backoff.expo,
+                          psycopg2.DatabaseError,
+                          max_tries=MAX_RETRIES,
+                          on_backoff=_log_backoff,
+                          base=_get_connect_timeout)
+    async def read(self, batch_size: int = None) -> (list, None):
+        total = len(self.tables)
+
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        if self.index >= total:
+            elapsed_time = time.strftime(
+                '%H:%M:%S', time.gmtime(time.time() - self.start_time))
+            self.log('Collection duration: {}'.format(elapsed_time))
+            return None  # no tables left, we're done
+
+        name = self.tables[self.index]['value']
+        schema, table = name.split('.', 1)
+        batch_size = batch_size or self.get_batch_size(name)
+
+        msg = 'Reading table {} ({}) out of {}'\
+              .format(self.index + 1, table, total)
+        self.log(msg)
+        self._report_progress(self.index + 1, total, msg)
+
+        if self.connector is None or self.connector.cursor is None:
+            with self.metrics.timer(name, 'connect_seconds'):
+                self.connector = await connect(self.source)
+            if not self.max_value and self.inckey:
+                with self.metrics.timer(name, 'max_value_seconds'):
+                    if await self.needs_max_value_async(schema, table):
+                        await self.execute_async(get_max_value_query(
+                            self.inckey, schema, table))
+                        self.max_value = \
+                            self.connector.cursor.fetchall()[0]['max']
+            with self.metrics.timer(name, 'declare_seconds'):
+                await self.open_cursor_async(schema, table)
+
+        fetch_start = time.perf_counter()
+        columns, rows = await self.fetch_async(batch_size)
+        elapsed = time.perf_counter() - fetch_start
+        self.metrics.add(name, fetch_seconds=elapsed, fetches=1)
+        self.learn_batch(name, rows, elapsed)
+
+        return self.emit_batch(name, columns, rows, elapsed)
+
+    async def needs_max_value_async(self, schema: str, table: str) -> bool:
+        """same as `needs_max_value`, looking the index up over the async
+        connection"""
+        if self.max_value_mode != 'auto' or not self.incval:
+            # decided without querying
+            return self.needs_max_value(schema, table)
+        await self.execute_async(get_index_query(schema, table, self.inckey))
+        return bool(self.connector.cursor.fetchall())
+
+    async def open_cursor_async(self, schema: str, table: str):
+        """declare the cursor of the table, within a transaction as async
+        connections are in autocommit mode"""
+        if self.excludes and (schema, table) not in self.columns:
+            # looked up ahead, as `get_query_opts` can't wait for them
+            await self.execute_async(get_columns_query(
+                get_query(schema, table, '', '', None)))
+            self.columns[(schema, table)] = [
+                c[0] for c in self.connector.cursor.description]
+        query = get_query(**self.get_query_opts(schema, table,
+                                                self.max_value))
+        if self.row_format == 'columnar':
+            await self.execute_async(get_columns_query(query))
+            self.column_types = [c[1] for c in
+                                 self.connector.cursor.description]
+        await self.execute_async('BEGIN')
+        await self.execute_async('DECLARE cur CURSOR FOR {}'.format(query))
+        if self.row_format != 'dict':
+            self.row_cursor = self.connector.connection.cursor()
+
+    async def fetch_async(self, batch_size: int) -> tuple:
+        """return the column names and the next `batch_size` rows of the
+        cursor. Column names are None when rows are dicts"""
+        cursor = self.row_cursor or self.connector.cursor
+        await self.execute_async(
+            'FETCH FORWARD {} FROM cur'.format(batch_size), cursor)
+        columns = None
+        if self.row_cursor is not None:
+            columns = [c[0] for c in cursor.description]
+        return columns, cursor.fetchall()
+
+    async def execute_async(self, query: str, cursor: object = None,
+                            params: list = None):
+        self.log(query, "Loaded: {}".format(self.connector.loaded))
+        try:
+            await execute(self.connector, query, cursor, params)
+        except psycopg2.errors.UndefinedColumn as e:
+            close_connection(self.connector)
+            if self.inckey:
+                raise PostgresInckeyError(
+                    'Incremental key "{}" does not exist in the '
+                    'table "{}"'.format(self.inckey,
+                                        self.tables[self.index]['value']))
+            raise e
+        except psycopg2.DatabaseError as e:
+            # Same as `execute`, the retry should start a new connection
+            close_connection(self.connector)
+            print('Raise error {}'.format(e))
+            raise e
+        except asyncio.CancelledError:
+            # the query may still be running, it ends with the connection
+            close_connection(self.connector)
+            raise
+        self.log("DONE", query)
+
+    def release_connection(self):
+        close_connection(self.connector)
@@ -0,0 +1,147 @@
+from array import array
+from collections.abc import Sequence
+from typing import Callable, Dict, List
+
+# the array typecodes of the fixed width numeric types, by their OID: int8,
+# int2, int4, oid, float4 and float8. float4 values are kept as doubles, as
+# they're returned by the cursor
+ARRAY_TYPECODES = {20: 'q', 21: 'h', 23: 'i', 26: 'I', 700: 'd', 701: 'd'}
+
+
+class Batch(Sequence):
+    """A batch of rows kept as tuples along with a single header of column
+    names and the internals (__tablename, __state etc.) shared by all of its
+    rows. Rows are only turned into dicts when they're accessed, so a batch
+    can be used anywhere a list of dicts is expected.
+
+    Columns given in `parsed` are converted with `parse` (a function of a
+    whole column of values) the first time the rows are accessed, once for
+    the batch rather than once per row."""
+
+    __slots__ = ('columns', '_rows', 'internals', 'parsed', 'parse')
+
+    def __init__(self, columns: List[str], rows: list, internals: Dict,
+                 parsed: List[int] = None, parse: Callable = None):
+        self.columns = columns
+        self._rows = rows
+        self.internals = internals
+        self.parsed = parsed
+        self.parse = parse
+
+    @property
+    def rows(self) -> list:
+        if self.parsed and self._rows:
+            values = [list(v) for v in zip(*self._rows)]
+            for i in self.parsed:
+                values[i] = self.parse(values[i])
+            self._rows = list(zip(*values))
+            self.parsed = None
+        return self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Batch(self.columns, self._rows[index], self.internals,
+                         self.parsed, self.parse)
+        return self._to_dict(self.rows[index])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self._to_dict(row)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return 'Batch(columns={}, rows={})'.format(self.columns,
+                                                   len(self._rows))
+
+    def to_dicts(self) -> List[Dict]:
+        return list(self)
+
+    def _to_dict(self, row) -> Dict:
+        row = dict(zip(self.columns, row))
+        row.update(self.internals)
+        return row
+
+
+class ColumnBatch(Sequence):
+    """A batch of rows kept as one sequence of values per column, along with
+    a schema header of (column, type OID) pairs and the internals shared by
+    all of its rows.
+
+    Columns of fixed width numeric types are packed into an `array.array`
+    (which NumPy can wrap without a copy with `numpy.frombuffer`), the other
+    columns, and columns holding NULLs, are lists. Rows can still be read as
+    dicts, so a batch can be used anywhere a list of dicts is expected."""
+
+    __slots__ = ('schema', 'columns', 'internals', 'length')
+
+    def __init__(self, schema: List[tuple], columns: list, internals: Dict,
+                 length: int):
+        self.schema = schema
+        self.columns = columns
+        self.internals = internals
+        self.length = length
+
+    @classmethod
+    def from_rows(cls, schema: List[tuple], rows: list,
+                  internals: Dict) -> 'ColumnBatch':
+        """transpose the rows (tuples) into columns"""
+        values = list(zip(*rows)) if rows else [()] * len(schema)
+        columns = [get_column(c, oid) for c, (_, oid) in zip(values, schema)]
+        return cls(schema, columns, internals, len(rows))
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.schema]
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ColumnBatch(self.schema, [c[index] for c in self.columns],
+                               self.internals,
+                               len(range(*index.indices(self.length))))
+        if index < 0:
+            index += self.length
+        row = {name: column[index]
+               for name, column in zip(self.names, self.columns)}
+        row.update(self.internals)
+        return row
+
+    def __iter__(self):
+        names = self.names
+        for values in zip(*self.columns):
+            row = dict(zip(names, values))
+            row.update(self.internals)
+            yield row
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return 'ColumnBatch(schema={}, rows={})'.format(self.schema,
+                                                        self.length)
+
+    def to_dicts(self) -> List[Dict]:
+        return list(self)
+
+
+def get_column(values: tuple, oid: int) -> (array, list):
+    """return the values of a column as an array when they're all of its
+    fixed width type, as a list otherwise"""
+    typecode = ARRAY_TYPECODES.get(oid)
+    if typecode:
+        try:
+            return array(typecode, values)
+        except (TypeError, OverflowError):
+            pass  # NULLs, or values returned as text (e.g. COPY)
+    return list(values)
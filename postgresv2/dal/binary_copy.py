@@ -0,0 +1,328 @@
+import datetime
+import json
+import struct
+from decimal import Decimal
+from functools import partial
+from typing import Callable, Dict, List
+
+import psycopg2.extensions
+
+from .connector import Connector
+from .copy_reader import CopyReader
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+HEADER_SIZE = len(SIGNATURE) + 8  # flags and header extension length
+
+# type OIDs, see pg_type
+BOOL = 16
+BYTEA = 17
+CHAR = 18
+NAME = 19
+INT8 = 20
+INT2 = 21
+INT4 = 23
+TEXT = 25
+OID = 26
+JSON = 114
+FLOAT4 = 700
+FLOAT8 = 701
+BPCHAR = 1042
+VARCHAR = 1043
+DATE = 1082
+TIMESTAMP = 1114
+TIMESTAMPTZ = 1184
+NUMERIC = 1700
+UUID = 2950
+JSONB = 3802
+
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_EPOCH_TZ = PG_EPOCH.replace(tzinfo=datetime.timezone.utc)
+PG_EPOCH_DATE = PG_EPOCH.date()
+INFINITY_64 = 2 ** 63 - 1
+INFINITY_32 = 2 ** 31 - 1
+
+# the session time zones in which timestamptz values are returned at UTC by
+# the cursor engine, in others they're converted by psycopg2 from their text
+UTC_ZONES = ('UTC', 'Etc/UTC', 'GMT', 'Etc/GMT', 'UCT', 'Etc/UCT',
+             'Universal', 'Zulu')
+
+NUMERIC_NEG = 0x4000
+NUMERIC_SPECIAL = {
+    0xC000: Decimal('NaN'),
+    0xD000: Decimal('Infinity'),
+    0xF000: Decimal('-Infinity'),
+}
+
+_int16 = struct.Struct('>h').unpack_from
+_int32 = struct.Struct('>i').unpack_from
+_uint32 = struct.Struct('>I').unpack_from
+_int64 = struct.Struct('>q').unpack_from
+_float4 = struct.Struct('>f').unpack_from
+_float8 = struct.Struct('>d').unpack_from
+_numeric_header = struct.Struct('>hhHh').unpack_from
+
+
+# Every decoder takes the buffer, the offset and the length of a value so
+# that values are decoded in place, without copying them out of the buffer
+
+
+def decode_text(buf: memoryview, offset: int, length: int,
+                codec: str = 'utf-8') -> str:
+    return str(buf[offset:offset + length], codec)
+
+
+def decode_bytea(buf: memoryview, offset: int, length: int) -> memoryview:
+    # copied, as the buffer is reused, and returned as a memoryview the same
+    # as the cursor engine does
+    return memoryview(bytes(buf[offset:offset + length]))
+
+
+def decode_bool(buf: memoryview, offset: int, length: int) -> bool:
+    return buf[offset] != 0
+
+
+def decode_int2(buf: memoryview, offset: int, length: int) -> int:
+    return _int16(buf, offset)[0]
+
+
+def decode_int4(buf: memoryview, offset: int, length: int) -> int:
+    return _int32(buf, offset)[0]
+
+
+def decode_oid(buf: memoryview, offset: int, length: int) -> int:
+    return _uint32(buf, offset)[0]
+
+
+def decode_int8(buf: memoryview, offset: int, length: int) -> int:
+    return _int64(buf, offset)[0]
+
+
+def decode_float4(buf: memoryview, offset: int, length: int) -> float:
+    return _float4(buf, offset)[0]
+
+
+def decode_float8(buf: memoryview, offset: int, length: int) -> float:
+    return _float8(buf, offset)[0]
+
+
+def decode_numeric(buf: memoryview, offset: int, length: int) -> Decimal:
+    ndigits, weight, sign, dscale = _numeric_header(buf, offset)
+    if sign in NUMERIC_SPECIAL:
+        return NUMERIC_SPECIAL[sign]
+
+    # digits are base 10000, `weight` is the exponent of the first one
+    digits = struct.unpack_from('>{}h'.format(ndigits), buf, offset + 8)
+    text = ('%04d' * ndigits) % digits
+    # number of decimal digits after the point
+    scale = (ndigits - weight - 1) * 4
+    if scale > len(text):
+        text = '0' * (scale - len(text)) + text
+    if scale > dscale:
+        text = text[:len(text) - (scale - dscale)]
+    elif scale < dscale:
+        text += '0' * (dscale - scale)
+    if dscale:
+        text = '{}.{}'.format(text[:-dscale] or '0', text[-dscale:])
+
+    return Decimal('-' + text if sign == NUMERIC_NEG else text or '0')
+
+
+def decode_date(buf: memoryview, offset: int, length: int) -> datetime.date:
+    days = _int32(buf, offset)[0]
+    if days == INFINITY_32:
+        return datetime.date.max
+    if days == -INFINITY_32 - 1:
+        return datetime.date.min
+    return PG_EPOCH_DATE + datetime.timedelta(days=days)
+
+
+def decode_timestamp(buf: memoryview, offset: int,
+                     length: int) -> datetime.datetime:
+    micros = _int64(buf, offset)[0]
+    if micros == INFINITY_64:
+        return datetime.datetime.max
+    if micros == -INFINITY_64 - 1:
+        return datetime.datetime.min
+    return PG_EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def decode_timestamptz(buf: memoryview, offset: int,
+                       length: int) -> datetime.datetime:
+    micros = _int64(buf, offset)[0]
+    if micros == INFINITY_64:
+        return datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+    if micros == -INFINITY_64 - 1:
+        return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    return PG_EPOCH_TZ + datetime.timedelta(microseconds=micros)
+
+
+def decode_uuid(buf: memoryview, offset: int, length: int) -> str:
+    # psycopg2 returns UUIDs as strings unless `register_uuid` is used
+    h = buf[offset:offset + 16].hex()
+    return '{}-{}-{}-{}-{}'.format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def decode_json(buf: memoryview, offset: int, length: int,
+                codec: str = 'utf-8'):
+    return json.loads(decode_text(buf, offset, length, codec))
+
+
+def decode_jsonb(buf: memoryview, offset: int, length: int,
+                 codec: str = 'utf-8'):
+    return json.loads(decode_jsonb_text(buf, offset, length, codec))
+
+
+def decode_jsonb_text(buf: memoryview, offset: int, length: int,
+                      codec: str = 'utf-8') -> str:
+    # the first byte is the version of the jsonb format
+    return decode_text(buf, offset + 1, length - 1, codec)
+
+
+DECODERS: Dict[int, Callable] = {
+    BOOL: decode_bool,
+    BYTEA: decode_bytea,
+    CHAR: decode_text,
+    NAME: decode_text,
+    INT8: decode_int8,
+    INT2: decode_int2,
+    INT4: decode_int4,
+    TEXT: decode_text,
+    OID: decode_oid,
+    JSON: decode_json,
+    FLOAT4: decode_float4,
+    FLOAT8: decode_float8,
+    BPCHAR: decode_text,
+    VARCHAR: decode_text,
+    DATE: decode_date,
+    TIMESTAMP: decode_timestamp,
+    TIMESTAMPTZ: decode_timestamptz,
+    NUMERIC: decode_numeric,
+    UUID: decode_uuid,
+    JSONB: decode_jsonb,
+}
+# json and jsonb values kept as their text
+RAW_JSON_DECODERS = dict(DECODERS)
+RAW_JSON_DECODERS.update({JSON: decode_text, JSONB: decode_jsonb_text})
+# the decoders of values sent in the client encoding
+TEXT_DECODERS = (decode_text, decode_json, decode_jsonb, decode_jsonb_text)
+
+
+def decode_rows(buf: memoryview, offset: int, decoders: List[Callable],
+                rows: list) -> (int, bool):
+    """decode the complete rows of `buf` starting at `offset` into `rows`,
+    return the offset of the first incomplete row and whether the end of
+    the output was reached"""
+    size = len(buf)
+    count = len(decoders)
+    int16 = _int16
+    int32 = _int32
+    while offset + 2 <= size:
+        fields = int16(buf, offset)[0]
+        if fields == -1:
+            return offset + 2, True
+        if fields != count:
+            raise ValueError('Expected {} fields in binary COPY row, got {}'
+                             .format(count, fields))
+
+        pos = offset + 2
+        row = []
+        append = row.append
+        try:
+            for decode in decoders:
+                length = int32(buf, pos)[0]
+                pos += 4
+                if length < 0:
+                    append(None)
+                    continue
+                if pos + length > size:
+                    return offset, False
+                append(decode(buf, pos, length))
+                pos += length
+        except struct.error:
+            # the length of the next value wasn't written yet
+            return offset, False
+
+        rows.append(row)
+        offset = pos
+
+    return offset, False
+
+
+def get_binary_query(query: str, columns: list, types: list,
+                     decoders: Dict[int, Callable] = DECODERS) -> str:
+    """return the query to COPY in binary format, columns of types with no
+    decoder are cast to text"""
+    if all(oid in decoders for oid in types):
+        return query
+
+    projection = ', '.join(
+        '"{}"'.format(c.replace('"', '""')) if oid in decoders
+        else '"{}"::text'.format(c.replace('"', '""'))
+        for c, oid in zip(columns, types)
+    )
+    return 'SELECT {} FROM ({}) AS q'.format(projection, query)
+
+
+class BinaryCopyReader(CopyReader):
+    """Streams the rows of a query with `COPY ... (FORMAT binary)` and
+    decodes them directly into the Python values of the cursor engine, json
+    and jsonb values are kept as text with `raw_json`"""
+
+    def __init__(self, connector: Connector, query: str, columns: list,
+                 types: list, chunk_size: int, raw_json: bool = False):
+        decoders = dict(RAW_JSON_DECODERS if raw_json else DECODERS)
+        timezone = connector.connection.info.parameter_status('TimeZone')
+        if timezone not in UTC_ZONES:
+            # cast to text, and converted into the session time zone by
+            # psycopg2 the same as the cursor engine does
+            del decoders[TIMESTAMPTZ]
+        query = get_binary_query(query, columns, types, decoders)
+        super(BinaryCopyReader, self).__init__(connector, query, columns,
+                                               chunk_size)
+        decoders.setdefault(TIMESTAMPTZ, self.decode_timestamptz)
+        # columns with no decoder were cast to text
+        self.decoders = [self.get_decoder(decoders.get(oid, decode_text))
+                         for oid in types]
+        self.buffer = bytearray()
+        self.header = False
+        self.done = False
+
+    def get_decoder(self, decode: Callable) -> Callable:
+        if decode in TEXT_DECODERS and self.codec not in ('utf_8', 'utf-8'):
+            return partial(decode, codec=self.codec)
+        return decode
+
+    def decode_timestamptz(self, buf: memoryview, offset: int,
+                           length: int) -> datetime.datetime:
+        text = decode_text(buf, offset, length, self.codec)
+        return psycopg2.extensions.PYDATETIMETZ(text, self.connector.cursor)
+
+    def get_copy_query(self) -> str:
+        return 'COPY ({}) TO STDOUT (FORMAT binary)'.format(self.query)
+
+    def parse(self, data: bytes) -> list:
+        self.buffer += data
+        if self.done:
+            return []
+
+        offset = 0
+        if not self.header:
+            if len(self.buffer) < HEADER_SIZE:
+                return []
+            if self.buffer[:len(SIGNATURE)] != SIGNATURE:
+                raise ValueError('Invalid binary COPY signature')
+            extension = _int32(self.buffer, len(SIGNATURE) + 4)[0]
+            if len(self.buffer) < HEADER_SIZE + extension:
+                return []
+            offset = HEADER_SIZE + extension
+            self.header = True
+
+        rows = []
+        with memoryview(self.buffer) as buf:
+            offset, self.done = decode_rows(buf, offset, self.decoders, rows)
+        del self.buffer[:offset]
+
+        return rows
+
+    def flush(self) -> list:
+        return []
@@ -0,0 +1,144 @@
+import queue
+import re
+import threading
+
+import psycopg2.extensions
+
+from .connector import Connector
+
+NULL = '\\N'
+ESCAPES = {
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
+}
+ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+
+_END = object()
+
+
+def unescape(value: str) -> str:
+    """unescape a value of the COPY text format"""
+    def replace(match):
+        seq = match.group(1)
+        if seq[0] == 'x' and len(seq) > 1:
+            return chr(int(seq[1:], 16))
+        if seq.isdigit():
+            return chr(int(seq, 8))
+        return ESCAPES.get(seq, seq)
+
+    return ESCAPE_RE.sub(replace, value)
+
+
+def parse_line(line: str) -> list:
+    """parse a single row of the COPY text format into a list of values"""
+    values = line.split('\t')
+    for i, value in enumerate(values):
+        if value == NULL:
+            values[i] = None
+        elif '\\' in value:
+            values[i] = unescape(value)
+
+    return values
+
+
+class CopyReader:
+    """Streams the rows of a query with `COPY (query) TO STDOUT`.
+
+    `copy_expert` blocks until the whole output was written, so it runs in a
+    background thread writing into this object, while `fetch` hands out the
+    parsed rows in batches. The rows queue is bounded so that the COPY waits
+    for the consumer instead of buffering the table in memory.
+    """
+
+    def __init__(self, connector: Connector, query: str, columns: list,
+                 chunk_size: int):
+        self.connector = connector
+        self.query = query
+        self.columns = columns
+        self.chunk_size = chunk_size
+        encoding = connector.connection.encoding
+        self.codec = psycopg2.extensions.encodings.get(encoding, 'utf-8')
+        self.buffer = ''
+        self.chunk = []
+        self.pending = []
+        self.rows = queue.Queue(maxsize=4)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._copy, daemon=True)
+        self.thread.start()
+
+    def fetch(self, size: int) -> list:
+        """return up to `size` rows as lists of values (in the order of
+        `columns`), an empty list once the whole output was read"""
+        rows = self.pending
+        while len(rows) < size:
+            chunk = self.rows.get()
+            if chunk is _END:
+                self.rows.put(_END)
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            rows.extend(chunk)
+
+        self.pending = rows[size:]
+        return rows[:size]
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            if self.thread.is_alive():
+                # cancel is the only call that's safe while the COPY is
+                # running in the other thread
+                self.connector.connection.cancel()
+            self.thread.join()
+            self.thread = None
+
+    def write(self, data: (bytes, str)):
+        """called by `copy_expert` with the output of the COPY"""
+        self.chunk.extend(self.parse(data))
+        if len(self.chunk) >= self.chunk_size:
+            if not self._put(self.chunk):
+                # the reader was closed, abort the COPY
+                raise psycopg2.extensions.QueryCanceledError('COPY aborted')
+            self.chunk = []
+
+    def get_copy_query(self) -> str:
+        return 'COPY ({}) TO STDOUT'.format(self.query)
+
+    def parse(self, data: (bytes, str)) -> list:
+        """return the rows of the complete lines written so far"""
+        if isinstance(data, bytes):
+            data = data.decode(self.codec)
+
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        return [parse_line(line) for line in lines]
+
+    def flush(self) -> list:
+        """return the rows left once the whole output was written"""
+        return [parse_line(self.buffer)] if self.buffer else []
+
+    def _copy(self):
+        try:
+            self.connector.cursor.copy_expert(self.get_copy_query(), self)
+            self.chunk.extend(self.flush())
+            if self.chunk:
+                self._put(self.chunk)
+            self._put(_END)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.rows.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
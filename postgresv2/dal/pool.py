@@ -0,0 +1,122 @@
+import threading
+import time
+from typing import Dict
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from .connector import Connector
+from .queries.consts import POOL_MAX_IDLE, POOL_IDLE_TIMEOUT, \
+    POOL_PING_AFTER
+from ..utils import connect, get_credentials, get_dsn, reset
+
+
+class ConnectionPool:
+    """Keeps connections open between tables and catalog calls instead of
+    connecting over and over again.
+
+    Connections are released at the end of a table (or a catalog call), and
+    handed out again to the next one with a fresh transaction and cursor.
+    """
+
+    def __init__(self, max_idle: int = POOL_MAX_IDLE,
+                 idle_timeout: int = POOL_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        # idle (connection, released at) pairs by source, see `get_key`
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, source: Dict) -> Connector:
+        """return a connector with a healthy connection to the source"""
+        key = get_key(source)
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                if not idle:
+                    break
+                connection, released_at = idle.pop()
+
+            if self._is_healthy(connection, released_at):
+                cursor = connection.cursor(
+                    cursor_factory=psycopg2.extras.RealDictCursor)
+                return Connector(connection=connection, cursor=cursor)
+            _close(connection)
+
+        return connect(source)
+
+    def release(self, source: Dict, connector: Connector):
+        """return the connection of the connector to the pool, the connector
+        is reset the same way as when it's closed"""
+        connection = connector.connection
+        if connection is None:
+            return  # already closed, e.g. after an error
+        try:
+            if connector.cursor:
+                connector.cursor.close()
+            # ends the transaction, along with the cursors declared in it
+            connection.rollback()
+        except psycopg2.Error:
+            _close(connection)
+            connection = None
+        finally:
+            reset(connector)
+
+        if connection is None or connection.closed:
+            return
+
+        key = get_key(source)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.monotonic()))
+                return
+        _close(connection)
+
+    def clear(self):
+        """close all the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                _close(connection)
+
+    def _is_healthy(self, connection, released_at: float) -> bool:
+        if connection.closed:
+            return False
+        idle_time = time.monotonic() - released_at
+        if idle_time > self.idle_timeout:
+            return False
+        status = connection.get_transaction_status()
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if idle_time > POOL_PING_AFTER:
+            # idle long enough for the server or the network to drop it
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+
+def get_key(source: Dict) -> tuple:
+    """connections are shared by the sources with the same DSN, credentials
+    and typecasters, so that a connection is never handed to a source with
+    another (or a wrong) password"""
+    return (get_dsn(source),) + get_credentials(source) + \
+        (source.get('__typeProfile'), bool(source.get('__parseJson')))
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except psycopg2.Error:
+        pass
+
+
+# shared by all the sources (and streams) of the process
+POOL = ConnectionPool()
@@ -1,10 +1,65 @@
 DESTINATION = 'postgres_{__tablename}'
 BATCH_SIZE = 5000
+# bounds of the batch size when batches are sized by bytes or fetch time
+PROBE_BATCH_SIZE = 500
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 100000
+ROW_SIZE_SAMPLE = 100  # rows sampled for estimating the size of a batch
 CONNECT_TIMEOUT = 15  # seconds
 MAX_RETRIES = 5
 RETRY_TIMEOUT = 2
+CONCURRENCY = 1  # tables read at once by a single stream
+MAX_CONCURRENCY = 16  # tables read at once by a stream or a scheduler
+# tables read at once from the same host by the scheduler, and the estimated
+# size of the batches it keeps fetched ahead of the consumer
+HOST_CONNECTIONS = 4
+SCHEDULER_MAX_BYTES = 256 * 2 ** 20
+SPLIT_MODES = ('ctid', 'pk', 'inckey')
+ENGINES = ('cursor', 'copy', 'keyset')
+COPY_FORMATS = ('text', 'binary')
+ROW_FORMATS = ('dict', 'tuple', 'columnar')
+TABLE_ORDERS = ('given', 'largest', 'smallest')
+TYPE_PROFILES = ('default', 'raw', 'typed')
+MAX_VALUE_MODES = ('query', 'auto', 'stream')
+COPY_CHUNK_SIZE = 1000  # rows handed over at once by the COPY thread
+SPOOL_COMPRESSION = 1  # zlib level of the spool files, favouring speed
+# idle connections kept open per source, and for how long (seconds)
+POOL_MAX_IDLE = 4
+POOL_IDLE_TIMEOUT = 300
+POOL_PING_AFTER = 30  # idle seconds after which a connection is checked
 
+CATALOG_TTL = 300  # seconds the tables of a source are cached for
+
+# same shape as information_schema.tables, which is a lot slower to query
 SQL_GET_ALL_TABLES = """
-        SELECT * FROM information_schema.tables
-        WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
+        SELECT n.nspname AS table_schema, c.relname AS table_name,
+            CASE c.relkind WHEN 'v' THEN 'VIEW' ELSE 'BASE TABLE' END
+                AS table_type,
+            c.reltuples::bigint AS estimated_rows
+        FROM pg_catalog.pg_class c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p', 'v')
+        AND n.nspname NOT IN ('information_schema', 'pg_catalog')
+        AND n.nspname !~ '^pg_(toast|temp)'
+        AND has_table_privilege(c.oid, 'SELECT')
+    """
+
+SQL_GET_TABLE_SIZES = """
+        SELECT n.nspname || '.' || c.relname AS table,
+            GREATEST(c.reltuples, 0)::bigint AS rows,
+            pg_total_relation_size(c.oid) AS bytes
+        FROM pg_catalog.pg_class c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname || '.' || c.relname = ANY(%s)
+    """
+
+# the snapshot of the coordinator transaction, shared by the connections
+# reading the tables in the consistent snapshot mode
+SQL_EXPORT_SNAPSHOT = """
+        SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;
+        SELECT pg_export_snapshot() AS snapshot
+    """
+SQL_SET_SNAPSHOT = """
+        SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;
+        SET TRANSACTION SNAPSHOT %s
     """
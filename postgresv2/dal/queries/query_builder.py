@@ -1,24 +1,47 @@
-from typing import Any
+import datetime
+from decimal import Decimal
+from typing import Any, List
+
+from .consts import SQL_GET_ALL_TABLES
 
 
 def get_query(schema: str, table: str, inckey: str, incval: Any,
-              max_value: Any) -> str:
-    """return a SELECT query using properties from the source"""
-    where = ''
+              max_value: Any, where: str = None,
+              columns: List[str] = None, order: List[str] = None) -> str:
+    """return a SELECT query using properties from the source, `where` is an
+    optional extra condition (e.g. the range of a split table), `columns`
+    an optional list of the columns to select (all of them by default) and
+    `order` the columns to order by instead of the incremental key"""
+    clauses = []
     orderby = get_orderby(inckey)
+    if order:
+        orderby = ' ORDER BY {}'.format(get_projection(order))
 
     if inckey and incval:
-        inc_clause = get_incremental(inckey, incval, max_value)
-        where = "{}{}".format(where, inc_clause)
+        clauses.append(get_incremental(inckey, incval, max_value))
+    if where:
+        clauses.append(where)
+    where = ' AND '.join(clauses)
 
     if where:
         where = ' WHERE {}'.format(where)
 
-    return 'SELECT * FROM "{}"."{}"{}{}'.format(
-        schema, table, where, orderby
+    return 'SELECT {} FROM "{}"."{}"{}{}'.format(
+        get_projection(columns), schema, table, where, orderby
     )
 
 
+def get_projection(columns: List[str] = None) -> str:
+    if columns is None:
+        return '*'
+    return ', '.join('"{}"'.format(c.replace('"', '""')) for c in columns)
+
+
+def get_columns_query(query: str) -> str:
+    """return a query for the columns of `query` without reading any row"""
+    return 'SELECT * FROM ({}) AS q LIMIT 0'.format(query)
+
+
 def get_orderby(inckey: str) -> str:
     orderby = ''
     if inckey:
@@ -38,9 +61,177 @@ def get_incremental(inckey: str, incval: Any, max_value: Any) -> str:
     return inc_clause
 
 
+def get_position_clause(columns: List[str], values: List[Any],
+                        inclusive: bool) -> str:
+    """return the condition of the rows after the position `values` in the
+    order of `columns`. An inclusive position also includes the rows at the
+    position itself, and the NULLs ordered after them."""
+    values = ', '.join("'{}'".format(str(v).replace("'", "''"))
+                       for v in values)
+    if len(columns) == 1:
+        clause = '{} {} {}'.format(get_projection(columns),
+                                   '>=' if inclusive else '>', values)
+        if inclusive:
+            clause = '({} OR {} IS NULL)'.format(clause,
+                                                 get_projection(columns))
+        return clause
+
+    return '({}) {} ({})'.format(get_projection(columns),
+                                 '>=' if inclusive else '>', values)
+
+
+def get_keyset_clause(columns: List[str]) -> str:
+    """return the condition of the rows after the position given by the
+    parameters of a prepared statement, in the order of `columns`"""
+    params = ', '.join('${}'.format(i + 1) for i in range(len(columns)))
+    return '({}) > ({})'.format(get_projection(columns), params)
+
+
+def get_primary_key_query(schema: str, table: str) -> str:
+    return ('SELECT a.attname AS column FROM pg_index i '
+            'JOIN pg_attribute a ON a.attrelid = i.indrelid '
+            'AND a.attnum = ANY(i.indkey) '
+            'WHERE i.indrelid = \'"{}"."{}"\'::regclass AND i.indisprimary '
+            'ORDER BY array_position(i.indkey::int2[], a.attnum)').format(
+                schema,
+                table
+            )
+
+
+def get_xmin_query(schema: str, table: str) -> str:
+    """return a query for the oldest transaction still running (as an epoch
+    extended 64-bit txid), and whether the relation has an `xmin` column"""
+    return ('SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin, '
+            'relkind IN (\'r\', \'p\', \'m\') AS has_xmin FROM pg_class '
+            'WHERE oid = \'"{}"."{}"\'::regclass').format(schema, table)
+
+
+def get_xmin_clause(last: int, current: int) -> (str, None):
+    """return the condition of the rows inserted or updated by transactions
+    from `last` on, given the current txid (both epoch extended). `xmin` has
+    no epoch, after a wraparound the new transactions are the ones below the
+    current txid. None when it wrapped around more than once, and all the
+    rows should be read."""
+    epochs = (current >> 32) - (last >> 32)
+    if epochs == 0:
+        return 'xmin::text::bigint >= {}'.format(last & 0xFFFFFFFF)
+    if epochs == 1:
+        return '(xmin::text::bigint >= {} OR xmin::text::bigint < {})'.format(
+            last & 0xFFFFFFFF, current & 0xFFFFFFFF)
+
+    return None
+
+
+def get_tables_query(prefix: str = None, limit: int = None,
+                     offset: int = 0) -> tuple:
+    """return the query for the tables whose name (or schema.name) starts
+    with `prefix`, `limit` tables at a time, along with its parameters"""
+    query = SQL_GET_ALL_TABLES
+    params = []
+    if prefix:
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_') + '%'
+        query += ("AND (n.nspname || '.' || c.relname LIKE %s "
+                  "OR c.relname LIKE %s)")
+        params += [pattern, pattern]
+    query += ' ORDER BY 1, 2'
+    if limit:
+        query += ' LIMIT %s OFFSET %s'
+        params += [limit, offset]
+
+    return query, params
+
+
+def get_index_query(schema: str, table: str, column: str) -> str:
+    """return a query for the valid btree indexes led by the column, which
+    answer its MAX() off the end of the index instead of scanning the table"""
+    return ('SELECT 1 FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_am am ON am.oid = c.relam '
+            'JOIN pg_attribute a ON a.attrelid = i.indrelid '
+            'AND a.attnum = i.indkey[0] '
+            'WHERE i.indrelid = \'"{}"."{}"\'::regclass '
+            'AND a.attname = \'{}\' AND am.amname = \'btree\' '
+            'AND i.indisvalid AND i.indpred IS NULL LIMIT 1').format(
+                schema,
+                table,
+                column.replace("'", "''")
+            )
+
+
 def get_max_value_query(column: str, schema: str, table: str) -> str:
     return 'SELECT MAX("{}") FROM "{}"."{}"'.format(
             column,
             schema,
             table
         )
+
+
+def get_relation_blocks_query(schema: str, table: str) -> str:
+    return ('SELECT pg_relation_size(\'"{}"."{}"\'::regclass) / '
+            'current_setting(\'block_size\')::int AS blocks').format(
+                schema,
+                table
+            )
+
+
+def get_min_max_query(column: str, schema: str, table: str,
+                      where: str = '') -> str:
+    if where:
+        where = ' WHERE {}'.format(where)
+    return 'SELECT MIN("{0}"), MAX("{0}") FROM "{1}"."{2}"{3}'.format(
+            column,
+            schema,
+            table,
+            where
+        )
+
+
+def get_split_bounds(lower: Any, upper: Any, parts: int) -> (List, None):
+    """split the [lower, upper] range into (up to) `parts` ranges of the same
+    size, return the inner bounds or None if the values can't be split"""
+    if lower is None or upper is None or parts < 2 or lower >= upper:
+        return None
+
+    if isinstance(lower, int) and isinstance(upper, int):
+        parts = min(parts, upper - lower + 1)
+        bounds = [lower + (upper - lower + 1) * i // parts
+                  for i in range(1, parts)]
+    elif isinstance(lower, (float, Decimal)) and \
+            isinstance(upper, (float, Decimal)):
+        bounds = [lower + (upper - lower) * i / parts
+                  for i in range(1, parts)]
+    elif isinstance(lower, datetime.date) and \
+            type(lower) is type(upper):
+        bounds = [lower + (upper - lower) * i // parts
+                  for i in range(1, parts)]
+    else:
+        return None
+
+    return sorted(set(bounds)) or None
+
+
+def get_key_ranges(column: str, bounds: List) -> List[str]:
+    """return the conditions of the ranges separated by `bounds`, NULL values
+    fall into the first range"""
+    ranges = ['("{0}" < \'{1}\' OR "{0}" IS NULL)'.format(column, bounds[0])]
+    for lower, upper in zip(bounds, bounds[1:]):
+        ranges.append('("{0}" >= \'{1}\' AND "{0}" < \'{2}\')'.format(
+            column, lower, upper))
+    ranges.append('"{}" >= \'{}\''.format(column, bounds[-1]))
+
+    return ranges
+
+
+def get_ctid_ranges(blocks: int, parts: int) -> List[str]:
+    """return the conditions of `parts` ranges of blocks, the last one is
+    open ended so that it includes blocks added since the table was sized"""
+    parts = min(parts, blocks)
+    bounds = [blocks * i // parts for i in range(1, parts)]
+    ranges = ["ctid < '({},0)'::tid".format(bounds[0])]
+    for lower, upper in zip(bounds, bounds[1:]):
+        ranges.append("(ctid >= '({},0)'::tid AND ctid < '({},0)'::tid)"
+                      .format(lower, upper))
+    ranges.append("ctid >= '({},0)'::tid".format(bounds[-1]))
+
+    return ranges
@@ -0,0 +1,221 @@
+import select
+import struct
+from typing import Dict, List
+
+import psycopg2.extensions
+
+from .connector import Connector
+
+# messages of the pgoutput protocol (version 1)
+BEGIN = b'B'[0]
+COMMIT = b'C'[0]
+RELATION = b'R'[0]
+INSERT = b'I'[0]
+UPDATE = b'U'[0]
+DELETE = b'D'[0]
+TRUNCATE = b'T'[0]
+
+OPERATIONS = {INSERT: 'insert', UPDATE: 'update', DELETE: 'delete'}
+
+SQL_GET_SLOT = 'SELECT 1 FROM pg_replication_slots WHERE slot_name = %s'
+SQL_CREATE_SLOT = "SELECT pg_create_logical_replication_slot(%s, 'pgoutput')"
+SQL_GET_CURRENT_LSN = 'SELECT pg_current_wal_lsn()::text AS lsn'
+# seconds to wait for the server between the messages of the stream
+STREAM_WAIT = 1
+
+
+def format_lsn(lsn: int) -> str:
+    return '{:X}/{:X}'.format(lsn >> 32, lsn & 0xFFFFFFFF)
+
+
+def parse_lsn(lsn: str) -> int:
+    high, low = lsn.split('/')
+    return int(high, 16) << 32 | int(low, 16)
+
+
+def read_string(data: bytes, offset: int) -> tuple:
+    end = data.index(b'\0', offset)
+    return data[offset:end].decode(), end + 1
+
+
+def decode_relation(data: bytes) -> tuple:
+    """return the oid of a relation message along with the schema, name and
+    (column, type oid) pairs of the relation"""
+    oid, = struct.unpack_from('!I', data, 1)
+    schema, offset = read_string(data, 5)
+    table, offset = read_string(data, offset)
+    count, = struct.unpack_from('!H', data, offset + 1)
+    offset += 3
+    columns = []
+    for _ in range(count):
+        name, offset = read_string(data, offset + 1)
+        type_oid, = struct.unpack_from('!I', data, offset)
+        columns.append((name, type_oid))
+        offset += 8
+
+    return oid, (schema, table, columns)
+
+
+def decode_tuple(data: bytes, offset: int, columns: List[tuple],
+                 cursor: object = None) -> tuple:
+    """return the row of the tuple data at `offset` and the offset after it,
+    values are cast the same way as the values of a cursor. Unchanged TOAST
+    values aren't sent, and are left out of the row"""
+    count, = struct.unpack_from('!H', data, offset)
+    offset += 2
+    row = {}
+    for name, type_oid in columns[:count]:
+        kind = data[offset]
+        offset += 1
+        if kind == b'n'[0]:
+            row[name] = None
+        elif kind == b't'[0]:
+            length, = struct.unpack_from('!I', data, offset)
+            offset += 4
+            value = data[offset:offset + length].decode()
+            offset += length
+            cast = psycopg2.extensions.string_types.get(type_oid)
+            row[name] = cast(value, cursor) if cast else value
+
+    return row, offset
+
+
+def decode_message(data: bytes, relations: Dict,
+                   cursor: object = None) -> (tuple, None):
+    """decode a pgoutput message into a (kind, relation, row) change, where
+    `relation` is the (schema, table, columns) of the changed table. Commits
+    are returned as ('commit', lsn, None) with the LSN after the commit.
+    Relation messages update `relations`, other messages return None."""
+    kind = data[0]
+    if kind == RELATION:
+        oid, relation = decode_relation(data)
+        relations[oid] = relation
+    elif kind == COMMIT:
+        end_lsn, = struct.unpack_from('!Q', data, 10)
+        return 'commit', format_lsn(end_lsn), None
+    elif kind in OPERATIONS:
+        oid, = struct.unpack_from('!I', data, 1)
+        relation = relations[oid]
+        offset = 5
+        if kind == UPDATE and data[offset] in b'KO':
+            # the old row (or its key), only the new one is returned
+            _, offset = decode_tuple(data, offset + 1, relation[2], cursor)
+        row, _ = decode_tuple(data, offset + 1, relation[2], cursor)
+        return OPERATIONS[kind], relation, row
+    elif kind == TRUNCATE:
+        count, = struct.unpack_from('!I', data, 1)
+        oids = struct.unpack_from('!{}I'.format(count), data, 6)
+        # a truncate message changes several relations at once
+        return 'truncate', [relations[oid] for oid in oids], None
+
+    return None
+
+
+class ChangeReader:
+    """Streams the changes of the tables of a publication out of a logical
+    replication slot (pgoutput), in batches of whole transactions.
+
+    The slot is created and the changes are cast over the connection of
+    `connector`, while they're streamed over a replication connection. The
+    stream starts after the changes returned so far, but the slot is only
+    advanced (by the feedback of the stream) to a position once it's
+    confirmed, so that the changes after the last confirmed position are
+    read again by the next reader."""
+
+    def __init__(self, connector: Connector, slot: str, publication: str):
+        self.connector = connector
+        self.slot = slot
+        self.publication = publication
+        self.relations = {}
+        # changes are read up to the position of the WAL when started
+        self.upto_lsn = None
+        # the position after the changes returned so far, and the confirmed
+        # one, which the slot is advanced to
+        self.position = None
+        self.confirmed = None
+        self.replication = None
+        self.done = False
+
+    def start(self):
+        cursor = self.connector.cursor
+        cursor.execute(SQL_GET_SLOT, [self.slot])
+        if not cursor.fetchall():
+            cursor.execute(SQL_CREATE_SLOT, [self.slot])
+        cursor.execute(SQL_GET_CURRENT_LSN)
+        self.upto_lsn = parse_lsn(cursor.fetchall()[0]['lsn'])
+        self.connector.connection.commit()
+
+    def confirm(self, lsn: str):
+        """advance the slot, the changes up to `lsn` won't be read again"""
+        self.confirmed = parse_lsn(lsn)
+        self.position = max(self.position or 0, self.confirmed)
+        if self.replication is not None:
+            self.replication.cursor.send_feedback(flush_lsn=self.confirmed)
+
+    def stream(self, replication: Connector):
+        """stream the changes after the position over the `replication`
+        connection"""
+        self.close()
+        self.replication = replication
+        # relations are sent again before their first change in the stream
+        self.relations = {}
+        replication.cursor.start_replication(
+            slot_name=self.slot, decode=False, start_lsn=self.position or 0,
+            options={'proto_version': '1',
+                     'publication_names': self.publication})
+        if self.confirmed is not None:
+            replication.cursor.send_feedback(flush_lsn=self.confirmed)
+
+    def fetch(self, count: int) -> tuple:
+        """return the (kind, relation, row) changes of the next transactions
+        committed after the position, up to about `count` messages, and the
+        position after the last one (None if there are none left)"""
+        cursor = self.replication.cursor
+        changes = []
+        lsn = None
+        messages = 0
+        in_transaction = False
+        while not self.done:
+            message = cursor.read_message()
+            if message is None:
+                if not in_transaction and cursor.wal_end >= self.upto_lsn:
+                    # the server is past the changes to read
+                    self.done = True
+                    break
+                # ask for the position of the server, and wait for it
+                cursor.send_feedback(reply=True)
+                select.select([cursor], [], [], STREAM_WAIT)
+                continue
+
+            data = message.payload
+            if data[0] == BEGIN:
+                final_lsn, = struct.unpack_from('!Q', data, 1)
+                if final_lsn > self.upto_lsn:
+                    # committed after the stream started
+                    self.done = True
+                    break
+                in_transaction = True
+
+            messages += 1
+            change = decode_message(data, self.relations,
+                                    self.connector.cursor)
+            if change is None:
+                continue
+            if change[0] == 'commit':
+                lsn = change[1]
+                self.position = parse_lsn(lsn)
+                in_transaction = False
+                if messages >= count:
+                    break
+            else:
+                changes.append(change)
+
+        return changes, lsn
+
+    def close(self):
+        if self.replication is not None:
+            try:
+                self.replication.connection.close()
+            except psycopg2.InterfaceError:
+                pass
+            self.replication = None
@@ -0,0 +1,76 @@
+import psycopg2
+import psycopg2.extensions
+
+try:
+    # a much faster parser, when it's installed
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+NUMERIC_OIDS = (1700,)
+NUMERIC_ARRAY_OIDS = (1231,)
+# date, time, timestamp, timestamptz, timetz and interval
+TEMPORAL_OIDS = (1082, 1083, 1114, 1184, 1266, 1186)
+# arrays of the builtin types psycopg2 converts into lists
+ARRAY_OIDS = (1000, 1005, 1007, 1009, 1014, 1015, 1016, 1021, 1022, 1115,
+              1182, 1183, 1185, 1187, 1231, 1270, 2951)
+# json and jsonb, and their arrays
+JSON_OIDS = (114, 3802)
+JSON_ARRAY_OIDS = (199, 3807)
+
+RAW = psycopg2.extensions.new_type(
+    NUMERIC_OIDS + TEMPORAL_OIDS + ARRAY_OIDS, 'RAW', psycopg2.STRING)
+NUMERIC_FLOAT = psycopg2.extensions.new_type(
+    NUMERIC_OIDS, 'NUMERIC_FLOAT', psycopg2.extensions.FLOAT)
+NUMERIC_FLOAT_ARRAY = psycopg2.extensions.new_array_type(
+    NUMERIC_ARRAY_OIDS, 'NUMERIC_FLOAT_ARRAY', NUMERIC_FLOAT)
+JSON_RAW = psycopg2.extensions.new_type(JSON_OIDS, 'JSON_RAW', psycopg2.STRING)
+JSON_RAW_ARRAY = psycopg2.extensions.new_array_type(
+    JSON_ARRAY_OIDS, 'JSON_RAW_ARRAY', JSON_RAW)
+
+# the typecasters of each conversion profile, on top of the default ones:
+# * raw - numeric, date/time, interval and array values are kept as the
+#   strings they're sent in (e.g. '1.50', '2020-01-01 00:00:00+00', '{1,2}')
+# * typed - numeric values are converted into floats rather than Decimals,
+#   which is a lot faster but loses precision beyond 15 digits
+PROFILES = {
+    'default': (),
+    'raw': (RAW,),
+    'typed': (NUMERIC_FLOAT, NUMERIC_FLOAT_ARRAY),
+}
+
+
+def register_profile(connection: object, profile: str):
+    """register the typecasters of the conversion profile on the
+    connection"""
+    for typecaster in PROFILES[profile]:
+        psycopg2.extensions.register_type(typecaster, connection)
+
+
+def register_json_raw(connection: object):
+    """keep the json and jsonb values of the connection as their text rather
+    than decoding them"""
+    psycopg2.extensions.register_type(JSON_RAW, connection)
+    psycopg2.extensions.register_type(JSON_RAW_ARRAY, connection)
+
+
+def parse_json(values: list) -> list:
+    """parse the JSON text values of a column, values which aren't strings
+    (e.g. NULLs or already decoded by the binary COPY) or aren't valid JSON
+    are returned as they are"""
+    try:
+        return [loads(v) if isinstance(v, str) else v for v in values]
+    except ValueError:
+        pass
+
+    # one of the values isn't valid JSON, parse them one by one
+    parsed = []
+    for value in values:
+        if isinstance(value, str):
+            try:
+                value = loads(value)
+            except ValueError:
+                pass
+        parsed.append(value)
+
+    return parsed
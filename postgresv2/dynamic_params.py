@@ -1,18 +1,68 @@
+import time
 from typing import Iterator
 
-from .dal.queries.consts import SQL_GET_ALL_TABLES
+from .dal.pool import POOL
+from .dal.queries.consts import CATALOG_TTL
+from .dal.queries.query_builder import get_tables_query
 from .utils import format_table_name, connect, close_connection,\
-    validate_host_and_port
+    validate_host_and_port, get_dsn, get_credentials
+
+# the tables listed by source and filter, along with when they were listed
+_tables_cache = {}
 
 
 def get_tables(source: dict) -> Iterator:
-    """get the list of tables from the source"""
+    """get the list of tables from the source, optionally only the ones
+    starting with `__tablesPrefix`, a page of `__tablesLimit` at a time"""
 
     validate_host_and_port(source)
-    connector = connect(source)
-    connector.cursor.execute(SQL_GET_ALL_TABLES)
+    key, query = get_tables_request(source)
+    cached = get_cached_tables(key)
+    if cached is not None:
+        return cached
+
+    # the connection can be reused by the extraction that follows
+    reuse = bool(source.get('__reuseConnections'))
+    connector = POOL.acquire(source) if reuse else connect(source)
+    connector.cursor.execute(*query)
     result = list(map(format_table_name, connector.cursor.fetchall()))
 
-    close_connection(connector)
+    if reuse:
+        POOL.release(source, connector)
+    else:
+        close_connection(connector)
+
+    return cache_tables(key, result)
+
+
+def get_tables_request(source: dict) -> tuple:
+    """return the cache key of the tables listed for the source, and the
+    (query, params) listing them"""
+    prefix = source.get('__tablesPrefix') or None
+    limit = source.get('__tablesLimit')
+    offset = int(source.get('__tablesOffset', 0))
+    key = (get_dsn(source),) + get_credentials(source) + \
+        (prefix, limit, offset)
+    return key, get_tables_query(prefix, limit, offset)
+
+
+def get_cached_tables(key: tuple) -> (list, None):
+    cached = _tables_cache.get(key)
+    if cached and time.monotonic() - cached[0] < CATALOG_TTL:
+        return list(cached[1])
+    return None
+
+
+def cache_tables(key: tuple, tables: list) -> list:
+    now = time.monotonic()
+    # the lists which expired are evicted, so the cache doesn't keep growing
+    # with every source and page listed by the process
+    for k, (listed, _) in list(_tables_cache.items()):
+        if now - listed >= CATALOG_TTL:
+            _tables_cache.pop(k, None)
+    _tables_cache[key] = (now, tables)
+    return list(tables)
+
 
-    return result
+def clear_tables_cache():
+    _tables_cache.clear()
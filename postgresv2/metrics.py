@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+# the metrics of a table, as (name, type, help) in the Prometheus textfile
+METRICS = (
+    ('connect_seconds', 'counter', 'Time spent connecting'),
+    ('max_value_seconds', 'counter',
+     'Time spent getting the max value of the incremental key'),
+    ('declare_seconds', 'counter',
+     'Time spent opening the cursor (or COPY) of the query'),
+    ('fetch_seconds', 'counter', 'Time spent fetching batches'),
+    ('convert_seconds', 'counter',
+     'Time spent converting the fetched rows into batches'),
+    ('fetches', 'counter', 'Batches fetched'),
+    ('rows', 'counter', 'Rows read'),
+    ('bytes', 'counter', 'Estimated size of the rows read, in bytes'),
+    ('retries', 'counter', 'Retries after errors'),
+)
+PREFIX = 'postgres_source_'
+
+
+class Metrics:
+    """Collects the timings and counts of the tables read by a stream (and
+    its workers in parallel mode).
+
+    Each batch and each completed table are handed to `hook` as a dict, and
+    the metrics of all the tables are written to `path` in the Prometheus
+    textfile format whenever a table is completed.
+    """
+
+    def __init__(self, hook: Callable = None, path: str = None):
+        self.hook = hook
+        self.path = path
+        self.tables = {}
+        self.lock = threading.Lock()
+        # the tables of parallel reads are completed by several threads, and
+        # the file is written by one of them at a time
+        self.write_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.hook or self.path)
+
+    def add(self, table: str, **values):
+        with self.lock:
+            metrics = self.tables.setdefault(
+                table, {name: 0 for name, _, _ in METRICS})
+            for name, value in values.items():
+                metrics[name] += value
+
+    @contextmanager
+    def timer(self, table: str, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(table, **{name: time.perf_counter() - start})
+
+    def batch(self, table: str, rows: int, size: int, fetch: float,
+              convert: float):
+        self.add(table, rows=rows, bytes=size, convert_seconds=convert)
+        if self.hook:
+            self.hook({'event': 'batch', 'table': table, 'rows': rows,
+                       'bytes': size, 'fetch_seconds': fetch,
+                       'convert_seconds': convert})
+
+    def table_done(self, table: str):
+        if self.hook:
+            with self.lock:
+                metrics = dict(self.tables.get(table, {}))
+            self.hook(dict(metrics, event='table', table=table))
+        if self.path:
+            self.write()
+
+    def write(self):
+        """write the metrics of all the tables in the Prometheus textfile
+        format, replacing the file at once so it's never read half written"""
+        with self.write_lock:
+            lines = []
+            with self.lock:
+                for name, kind, description in METRICS:
+                    metric = '{}{}_total'.format(PREFIX, name)
+                    lines.append('# HELP {} {}'.format(metric, description))
+                    lines.append('# TYPE {} {}'.format(metric, kind))
+                    for table, metrics in sorted(self.tables.items()):
+                        label = table.replace('\\', '\\\\') \
+                            .replace('"', '\\"')
+                        lines.append('{}{{table="{}"}} {}'.format(
+                            metric, label, metrics[name]))
+
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp, self.path)
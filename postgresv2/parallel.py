@@ -0,0 +1,98 @@
+import queue
+import threading
+from typing import Callable, Iterable
+
+from .dal.queries.consts import MAX_CONCURRENCY
+
+_DONE = object()
+
+
+class ParallelReader:
+    """Read several tasks (tables) at once on a bounded pool of threads.
+
+    Every task is handed to `open_task` which must return a reader object
+    with a `read()` method returning batches until an empty batch marks the
+    end of the task. Batches are handed back through `get()` in the order
+    they were fetched. No more than `concurrency` tasks are read at once,
+    one by each thread of the reader.
+    """
+
+    def __init__(self, tasks: Iterable, open_task: Callable,
+                 concurrency: int):
+        self.concurrency = max(1, min(concurrency, MAX_CONCURRENCY))
+        self.open_task = open_task
+        self.tasks = queue.Queue()
+        for task in tasks:
+            self.tasks.put(task)
+        self.pending = self.tasks.qsize()
+        # Bounded so that fast workers wait for the consumer instead of
+        # piling up batches in memory
+        self.results = queue.Queue(maxsize=self.concurrency * 2)
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for _ in range(min(self.concurrency, self.pending)):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def get(self) -> (tuple, None):
+        """return the next (task, batch) pair, an empty batch signals that
+        the task is done, None is returned once all tasks are done"""
+        if not self.pending:
+            return None
+
+        task, batch = self.results.get()
+        if isinstance(batch, Exception):
+            self.close()
+            raise batch
+
+        if batch is _DONE:
+            self.pending -= 1
+            batch = []
+
+        return task, batch
+
+    def close(self):
+        self.stopped.set()
+        # unblock workers waiting on a full results queue
+        while True:
+            try:
+                self.results.get_nowait()
+            except queue.Empty:
+                break
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while not self.stopped.is_set():
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                return
+
+            reader = None
+            try:
+                reader = self.open_task(task)
+                while not self.stopped.is_set():
+                    batch = reader.read()
+                    if not batch:
+                        break
+                    self._put(task, batch)
+                self._put(task, _DONE)
+            except Exception as e:
+                self._put(task, e)
+                return
+            finally:
+                if reader is not None:
+                    reader.close()
+
+    def _put(self, task, item):
+        while not self.stopped.is_set():
+            try:
+                self.results.put((task, item), timeout=1)
+                return
+            except queue.Full:
+                continue
@@ -1,4 +1,6 @@
+import os
 import sys
+import tempfile
 import time
 import uuid
 from typing import Any
@@ -7,13 +9,31 @@ import backoff
 import psycopg2.extras
 
 from .dal.queries.consts import *
-from .dal.queries.query_builder import get_query, get_max_value_query
-from .exceptions import PostgresInckeyError
+from .batch import Batch, ColumnBatch
+from .dal.binary_copy import BinaryCopyReader
+from .dal.connector import Connector
+from .dal.copy_reader import CopyReader
+from .dal.pool import POOL
+from .dal.replication import ChangeReader
+from .dal.types import parse_json
+from .dal.queries.query_builder import get_query, get_max_value_query, \
+    get_columns_query, get_incremental, get_relation_blocks_query, \
+    get_min_max_query, get_split_bounds, get_key_ranges, get_ctid_ranges, \
+    get_position_clause, get_keyset_clause, get_primary_key_query, \
+    get_xmin_query, get_xmin_clause, get_index_query
+from .exceptions import PostgresInckeyError, PostgresValidationError
+from .metrics import Metrics
+from .parallel import ParallelReader
+from .prefetch import Prefetcher
+from .spool import Spool, get_spool_path, is_spool_path
 from .utils import *
 
 
 def _log_backoff(details: dict):
     err = sys.exc_info()[1]
+    stream = details['args'][0]
+    if stream.index < len(stream.tables):
+        stream.metrics.add(stream.tables[stream.index]['value'], retries=1)
     print('Retrying (attempt {}) in {:.2f} seconds, after error {}: {}'.format(
         details['tries'],
         details['wait'],
@@ -37,18 +57,167 @@ class Postgres(panoply.DataSource):
             self.source["destination"] = DESTINATION
         validate_host_and_port(source)
         self.batch_size = source.get('__batchSize', BATCH_SIZE)
+        # Batches can be sized by a budget of bytes and/or fetch time instead
+        # of a fixed number of rows
+        self.batch_bytes = int(source.get('__batchBytes', 0))
+        self.batch_latency = float(source.get('__batchLatency', 0))
+        # number of batches fetched ahead in the background, and their limit
+        # in bytes
+        self.prefetch = int(source.get('__prefetch', 0))
+        self.prefetch_bytes = int(source.get('__prefetchBytes', 0))
+        # tables can rather be drained into a local file, in `spool_dir`, and
+        # served from it so the scan doesn't wait for the consumer
+        self.spool_dir = None
+        if source.get('__spool'):
+            self.spool_dir = source.get('__spoolDir') or tempfile.gettempdir()
+        if self.spool_dir and self.prefetch:
+            raise PostgresValidationError(
+                'A spool can\'t be used along with prefetching')
+        self.engine = source.get('__engine', 'cursor')
+        if self.engine not in ENGINES:
+            raise PostgresValidationError(
+                'Unknown extraction engine "{}"'.format(self.engine))
+        self.copy_format = source.get('__copyFormat', 'text')
+        if self.copy_format not in COPY_FORMATS:
+            raise PostgresValidationError(
+                'Unknown COPY format "{}"'.format(self.copy_format))
+        self.row_format = source.get('__rowFormat', 'dict')
+        if self.row_format not in ROW_FORMATS:
+            raise PostgresValidationError(
+                'Unknown row format "{}"'.format(self.row_format))
+        type_profile = source.get('__typeProfile', 'default')
+        if type_profile not in TYPE_PROFILES:
+            raise PostgresValidationError(
+                'Unknown type profile "{}"'.format(type_profile))
+        self.concurrency = int(source.get('__concurrency', CONCURRENCY))
+        # Large tables can be split into ranges read concurrently
+        self.split_mode = source.get('__splitMode')
+        if self.split_mode and self.split_mode not in SPLIT_MODES:
+            raise PostgresValidationError(
+                'Unknown split mode "{}"'.format(self.split_mode))
+        self.split_count = int(source.get('__splitCount', self.concurrency))
+        # Tables can be planned by their size before they're read
+        self.table_order = source.get('__tableOrder')
+        if self.table_order and self.table_order not in TABLE_ORDERS:
+            raise PostgresValidationError(
+                'Unknown table order "{}"'.format(self.table_order))
         tables = source.get('data_available', [])
         self.tables = tables[:]
         self.index = 0
         self.connector = None
+        self.copy_reader = None
+        # cursor returning tuples, used for fetching in the tuple and
+        # columnar row formats
+        self.row_cursor = None
+        # type OIDs of the columns of the table, for the columnar format
+        self.column_types = None
+        self.prefetcher = None
+        self.spool = None
+        # the spool of a stopped stream is kept for resuming from it
+        self.keep_spool = True
+        # key of the table paged by the keyset engine, and the key values of
+        # the last row fetched
+        self.keyset_key = None
+        self.keyset_position = None
         self.state_id = None
         self.current_keys = None
         self.inckey = source.get('inckey', '')
+        if self.split_mode == 'inckey' and not self.inckey:
+            raise PostgresValidationError(
+                'Splitting by the incremental key requires an inckey')
+        if self.split_mode and self.concurrency < 2:
+            self.log('Tables are only split with a __concurrency over 1, '
+                     'reading them whole')
         self.incval = source.get('incval', '')
+        self.idpattern = source.get('idpattern', '')
+        # how the upper bound of the incremental key is found, by a MAX()
+        # query, only when it's indexed, or by the snapshot of the query
+        # reading the table
+        self.max_value_mode = source.get('__maxValueMode', 'query')
+        if self.max_value_mode not in MAX_VALUE_MODES:
+            raise PostgresValidationError(
+                'Unknown max value mode "{}"'.format(self.max_value_mode))
+        self.excludes = get_excludes(source)
+        # JSON columns are kept as text, and the `stringFields` among them
+        # are parsed once per batch
+        self.parse_json = bool(source.get('__parseJson'))
+        self.string_fields = get_string_fields(source) \
+            if self.parse_json else []
+        # the columns of each table, looked up once when columns are excluded
+        self.columns = {}
+        # extra condition of the query, used by workers reading a range
+        self.where = None
 
         state = source.get('state', {})
         self.index = state.get('last_index', 0)
-        self.max_value = None
+        # tables beyond `last_index` which were already read in parallel mode
+        self.completed = set(state.get('completed', []))
+        # average row width (bytes) of each table, learned when sizing
+        # batches by bytes
+        self.row_widths = state.get('row_widths', {})
+        self.fetch_rates = {}
+        # position inside the table at `last_index`, the key values of the
+        # last row returned so far
+        self.resume_by_key = bool(source.get('__resumeByPrimaryKey'))
+        self.last_value = state.get('last_value')
+        self.rows_emitted = state.get('rows_emitted', 0)
+        # the spool file of the table at `last_index`, and the offset of the
+        # next batch in it
+        self.spool_path = state.get('spool_path')
+        self.spool_offset = state.get('spool_offset', 0)
+        self.pool = None
+        # timings and counts of the tables, handed to the `metrics` hook of
+        # the options and/or written to a Prometheus textfile
+        self.metrics = Metrics(options.get('metrics'),
+                               source.get('__metricsFile'))
+        # connections are kept open between tables instead of reconnecting
+        self.reuse_connections = bool(source.get('__reuseConnections'))
+        # changes are streamed from a logical replication slot in CDC mode,
+        # up to the position confirmed so far
+        self.slot = source.get('__replicationSlot')
+        self.publication = source.get('__publication')
+        if self.slot and not self.publication:
+            raise PostgresValidationError(
+                'A publication is required for reading the changes of the '
+                'replication slot "{}"'.format(self.slot))
+        self.change_reader = None
+        self.caught_up = False
+        self.confirmed_lsn = state.get('confirmed_lsn')
+        # tables without an incremental key can be synced by the `xmin` of
+        # their rows, from the txid at which each table was last read
+        self.xmin_sync = bool(source.get('__xminSync')) and not self.inckey
+        if self.xmin_sync and self.concurrency > 1:
+            raise PostgresValidationError(
+                'Syncing by xmin isn\'t supported in parallel mode')
+        self.xmin_values = state.get('xmin_values', {})
+        # the txid of the table being read, for the next sync
+        self.xmin_next = state.get('xmin_next')
+        self.xmin_where = None
+        # all the tables are read in the snapshot exported by a coordinator
+        # connection, which is kept open until they're all read
+        self.consistent_snapshot = bool(source.get('__consistentSnapshot'))
+        if self.consistent_snapshot and (self.engine == 'keyset' or
+                                         self.slot):
+            raise PostgresValidationError(
+                'A consistent snapshot can\'t be used with the keyset engine '
+                'or a replication slot')
+        self.snapshot = None
+        self.coordinator = None
+        # the order in which the tables were planned, and their estimated
+        # (rows, bytes)
+        self.plan = state.get('plan')
+        self.sizes = None
+        if self.xmin_sync and self.index >= len(self.tables):
+            # the state of a finished sync is where the next one starts
+            self.index = 0
+            self.completed = set()
+            self.plan = None
+        if self.plan:
+            # the indexes of the state are the ones of the planned order,
+            # even once the tables aren't planned anymore
+            self.apply_plan()
+        # a resumed table keeps the upper bound it was started with
+        self.max_value = state.get('max_value') if self.last_value else None
 
         # Remove the state object from the source definition
         # since it does not need to be saved on the source.
@@ -61,42 +230,111 @@ class Postgres(panoply.DataSource):
                           on_backoff=_log_backoff,
                           base=_get_connect_timeout)
     def read(self, batch_size: int = None) -> (list, None):
-        batch_size = batch_size or self.batch_size
         total = len(self.tables)
 
         if self.start_time is None:
             self.start_time = time.time()
 
+        if self.slot:
+            return self._read_changes(batch_size or self.batch_size)
+
         if self.index >= total:
             end_time = time.time()
             elapsed_time = time.strftime('%H:%M:%S',
                                          time.gmtime(
                                              end_time - self.start_time))
             self.log('Collection duration: {}'.format(elapsed_time))
+            self.close_snapshot()
             return None  # no tables left, we're done
 
-        schema, table = self.tables[self.index]['value'].split('.', 1)
+        if self.consistent_snapshot and self.snapshot is None:
+            self.export_snapshot()
+
+        if self.table_order and self.sizes is None:
+            self.plan_tables()
+
+        if self.concurrency > 1:
+            return self._read_parallel(batch_size)
+
+        name = self.tables[self.index]['value']
+        schema, table = name.split('.', 1)
+        requested_size = batch_size
+        batch_size = batch_size or self.get_batch_size(name)
 
         msg = 'Reading table {} ({}) out of {}'\
               .format(self.index + 1, table, total)
         self.log(msg)
-        self.progress(self.index + 1, total, msg)
+        self._report_progress(self.index + 1, total, msg)
 
-        if self.connector is None or self.connector.cursor is None:
-            self.connector = connect(self.source)
+        if self.spool_path:
+            self.resume_spool()
+        if self.spool is None and (self.connector is None or
+                                   self.connector.cursor is None):
+            with self.metrics.timer(name, 'connect_seconds'):
+                self.connector = self.open_connection()
 
             if not self.max_value:
-                self.max_value = self.get_max_value(schema, table, self.inckey)
+                with self.metrics.timer(name, 'max_value_seconds'):
+                    if self.needs_max_value(schema, table):
+                        self.max_value = self.get_max_value(schema, table,
+                                                            self.inckey)
+            if self.xmin_sync:
+                self.xmin_where = self.get_xmin_where(schema, table, name)
+            if self.engine == 'keyset':
+                self.keyset_key = self.get_keyset_key(schema, table)
             query_opts = self.get_query_opts(schema, table, self.max_value)
 
-            q = get_query(**query_opts)
-            self.execute('DECLARE cur CURSOR FOR {}'.format(q))
+            with self.metrics.timer(name, 'declare_seconds'):
+                if self.keyset_key:
+                    self.open_keyset(query_opts)
+                else:
+                    q = get_query(**query_opts)
+                    self.open_cursor(q)
+            if self.prefetch:
+                # batches are sized as they're fetched in the background
+                self.prefetcher = Prefetcher(
+                    lambda: self.fetch_batch(
+                        name, requested_size or self.get_batch_size(name)),
+                    self.prefetch,
+                    self.prefetch_bytes
+                )
+                self.prefetcher.start()
+            elif self.spool_dir:
+                self.spool = Spool(
+                    get_spool_path(self.spool_dir),
+                    lambda: self.fetch_batch(
+                        name, requested_size or self.get_batch_size(name))
+                )
+                self.spool.start()
 
         # read n(=BATCH_SIZE) records from the table
-        self.execute('FETCH FORWARD {} FROM cur'.format(batch_size))
-        result = self.connector.cursor.fetchall()
+        fetch_start = time.perf_counter()
+        try:
+            if self.prefetcher is not None or self.spool is not None:
+                columns, rows = (self.prefetcher or self.spool).get()
+            else:
+                columns, rows = self.fetch_batch(name, batch_size)
+        except Exception:
+            # the retry should start over with a new connection
+            self.close_table()
+            raise
+        fetch_time = time.perf_counter() - fetch_start
+        if self.spool is not None and self.spool.drained and \
+                self.connector.cursor is not None:
+            # the whole table was spooled, its transaction can end
+            self.close_scan()
+
+        return self.emit_batch(name, columns, rows, fetch_time)
 
-        self.state_id = str(uuid.uuid4())
+    def emit_batch(self, name: str, columns: (list, None), rows: list,
+                   fetch_time: float) -> (list, Batch, ColumnBatch):
+        """return the fetched rows of the table as a batch, and move on to
+        the next table once there are none left"""
+        schema, table = name.split('.', 1)
+        if rows or self.state_id is None:
+            # the end of a table has no rows to carry its state, which is
+            # reported along with the last batch's rows instead
+            self.state_id = str(uuid.uuid4())
         # Add __schemaname and __tablename to each row so it would be available
         # as `destination` parameter if needed and also in case multiple tables
         # are pulled into the same destination table.
@@ -107,24 +345,679 @@ class Postgres(panoply.DataSource):
             __databasename=self.source.get('db_name'),
             __state=self.state_id
         )
-        result = [dict(r, **internals) for r in result]
+        convert_start = time.perf_counter()
+        result = self.get_batch(columns, rows, internals)
+        convert_time = time.perf_counter() - convert_start
+        size = get_rows_size(rows) if self.metrics.enabled else 0
+        self.metrics.batch(name, len(result), size, fetch_time, convert_time)
         self.connector.loaded += len(result)
+        self.rows_emitted += len(result)
+        self.update_position(columns, rows)
 
         # no more rows for this table, clear and proceed to next table
         if not result:
             self.log('Finished collection of table: {}'.format(table))
-            close_connection(self.connector)
+            self.close_table()
+            self.metrics.table_done(name)
             self.index += 1
             self.max_value = None
+            self.last_value = None
+            self.rows_emitted = 0
+            if self.xmin_next is not None:
+                # the next sync of the table starts from here
+                self.xmin_values[name] = self.xmin_next
+                self.xmin_next = None
+                self._report_state(self.index)
         else:
             self._report_state(self.index)
 
         return result
 
-    def execute(self, query: str):
+    def read_columnar(self, batch_size: int = None) -> (ColumnBatch, None):
+        """same as `read`, with every batch returned as a `ColumnBatch` of
+        column arrays rather than a list of dicts"""
+        self.row_format = 'columnar'
+        return self.read(batch_size)
+
+    def _read_changes(self, batch_size: int) -> (list, None):
+        """read a batch of the changes of the tables from the replication
+        slot, None once all the changes committed before the stream started
+        were read"""
+        if self.caught_up:
+            return None
+
+        try:
+            if self.connector is None or self.connector.cursor is None:
+                self.connector = self.open_connection()
+                if self.change_reader is None:
+                    change_reader = ChangeReader(
+                        self.connector, self.slot, self.publication)
+                    change_reader.start()
+                    if self.confirmed_lsn:
+                        # the state of the previous stream was saved, so
+                        # were the changes it returned
+                        change_reader.confirm(self.confirmed_lsn)
+                    self.change_reader = change_reader
+                else:
+                    self.change_reader.connector = self.connector
+                # a retry carries on after the changes returned so far
+                self.change_reader.stream(connect_replication(self.source))
+
+            result = []
+            while not result:
+                changes, lsn = self.change_reader.fetch(batch_size)
+                if lsn is None:
+                    self.log('Finished reading the changes of slot: {}'
+                             .format(self.slot))
+                    self.caught_up = True
+                    self.change_reader.close()
+                    self.release_connection()
+                    return None
+
+                self.confirmed_lsn = lsn
+                self.state_id = str(uuid.uuid4())
+                result = self.get_change_rows(changes)
+        except psycopg2.DatabaseError as e:
+            # Same as `execute`, the retry should start a new connection
+            close_connection(self.connector)
+            if self.change_reader is not None:
+                self.change_reader.close()
+            print('Raise error {}'.format(e))
+            raise e
+
+        self._report_state(self.index)
+
+        return result
+
+    def get_change_rows(self, changes: list) -> list:
+        """return the changed rows of the selected tables with the internals
+        added, along with the kind of change (`__op`)"""
+        names = {t['value'] for t in self.tables}
+        rows = []
+        for kind, relations, row in changes:
+            if kind != 'truncate':
+                relations = [relations]
+            for schema, table, _ in relations:
+                if names and '{}.{}'.format(schema, table) not in names:
+                    continue
+                row = {k: v for k, v in (row or {}).items()
+                       if k not in self.excludes}
+                rows.append(dict(
+                    row,
+                    __tablename=table,
+                    __schemaname=schema,
+                    __databasename=self.source.get('db_name'),
+                    __state=self.state_id,
+                    __op=kind
+                ))
+
+        return rows
+
+    def _read_parallel(self, batch_size: int) -> list:
+        """read a batch out of the tables that are being read concurrently,
+        each one by its own `TableWorker` over its own connection"""
+        total = len(self.tables)
+        if self.pool is None:
+            pending = [i for i in range(self.index, total)
+                       if i not in self.completed]
+            tasks = self.get_tasks(pending)
+            # number of ranges still being read for each table
+            self.parts = {}
+            for index, _, _ in tasks:
+                self.parts[index] = self.parts.get(index, 0) + 1
+
+            self.pool = ParallelReader(
+                tasks,
+                lambda task: TableWorker(self, task, batch_size),
+                self.concurrency
+            )
+            self.pool.start()
+
+        try:
+            item = self.pool.get()
+        except Exception:
+            # The pool is closed on errors, the retry will start a new one
+            # for the tables which were not completed yet
+            self.pool = None
+            raise
+
+        if item is None:
+            self.pool = None
+            self.index = total
+            return self.read(batch_size)
+
+        (index, _, _), result = item
+        return self.collect_batch(index, result)
+
+    def collect_batch(self, index: int, result: list) -> list:
+        """account for a batch of the table at `index` read by a worker, an
+        empty batch marks the end of one of the parts of the table, and
+        report the state of the stream"""
+        if not result:
+            self.parts[index] -= 1
+            if self.parts[index]:
+                return result  # other ranges of this table are still read
+
+            self.completed.add(index)
+            while self.index in self.completed:
+                self.completed.remove(self.index)
+                self.index += 1
+
+            loaded = self.index + len(self.completed)
+            total = len(self.tables)
+            msg = 'Read {} tables out of {}'.format(loaded, total)
+            self.log(msg)
+            self._report_progress(loaded, total, msg)
+            return result
+
+        # All the rows of a batch share the state ID set by the worker
+        self.state_id = result[0]['__state']
+        self._report_state(self.index)
+
+        return result
+
+    def plan_tables(self):
+        """order the tables by their size, or as they were first planned when
+        resumed, and keep their estimated size for reporting the progress"""
+        self.connector = self.open_connection()
+        try:
+            self.execute(SQL_GET_TABLE_SIZES, params=[
+                [t['value'] for t in self.tables]])
+            sizes = self.connector.cursor.fetchall()
+        finally:
+            self.release_connection()
+
+        self.sizes = {r['table']: (r['rows'], r['bytes']) for r in sizes}
+        if self.plan:
+            self.apply_plan()
+        elif self.table_order != 'given':
+            self.tables.sort(
+                key=lambda t: self.sizes.get(t['value'], (0, 0))[1],
+                reverse=self.table_order == 'largest')
+        self.plan = [t['value'] for t in self.tables]
+
+    def apply_plan(self):
+        """order the tables as they were planned, the tables which weren't
+        planned come last"""
+        order = {value: i for i, value in enumerate(self.plan)}
+        self.tables.sort(key=lambda t: order.get(t['value'], len(order)))
+
+    def _report_progress(self, loaded: int, total: int, msg: str):
+        """report the progress in tables, or in estimated rows (and bytes)
+        when the tables were planned"""
+        if self.sizes is None:
+            self.progress(loaded, total, msg)
+            return
+
+        total_rows = total_bytes = loaded_rows = loaded_bytes = 0
+        for i, t in enumerate(self.tables):
+            rows, size = self.sizes.get(t['value'], (0, 0))
+            total_rows += rows
+            total_bytes += size
+            if i < self.index or i in self.completed:
+                loaded_rows += rows
+                loaded_bytes += size
+            elif i == self.index and rows:
+                # part of the table being read
+                read = min(self.rows_emitted, rows)
+                loaded_rows += read
+                loaded_bytes += size * read // rows
+
+        msg = '{} (~{:,} of ~{:,} rows, {:,.1f} of {:,.1f} MB)'.format(
+            msg, loaded_rows, total_rows, loaded_bytes / 1e6,
+            total_bytes / 1e6)
+        self.progress(loaded_rows, total_rows, msg)
+
+    def get_tasks(self, indexes: list) -> list:
+        """return the (index, where, max_value) tasks for reading the tables
+        in parallel, a table is split into several tasks in split mode"""
+        if not self.split_mode or self.split_count < 2:
+            return [(index, None, None) for index in indexes]
+
+        tasks = []
+        self.connector = self.open_connection()
+        try:
+            for index in indexes:
+                schema, table = self.tables[index]['value'].split('.', 1)
+                ranges, max_value = self.get_ranges(schema, table)
+                tasks.extend((index, where, max_value)
+                             for where in ranges or [None])
+        finally:
+            self.release_connection()
+
+        return tasks
+
+    def get_ranges(self, schema: str, table: str) -> tuple:
+        """return the conditions of the disjoint ranges of a table to be read
+        concurrently (None if the table can't be split) along with the max
+        value of the incremental key shared by all the ranges"""
+        if self.split_mode == 'inckey':
+            # The bounds of the inckey are needed anyway, no need for
+            # another MAX() query
+            column = self.inckey
+            where = ''
+            if self.incval:
+                where = get_incremental(self.inckey, self.incval, None)
+            lower, upper = self.get_min_max(schema, table, column, where)
+            bounds = get_split_bounds(lower, upper, self.split_count)
+            return bounds and get_key_ranges(column, bounds), upper
+
+        max_value = self.get_max_value(schema, table, self.inckey)
+        if self.split_mode == 'ctid':
+            self.execute(get_relation_blocks_query(schema, table))
+            blocks = self.connector.cursor.fetchall()[0]['blocks']
+            if blocks < 2:
+                return None, max_value
+            return get_ctid_ranges(blocks, self.split_count), max_value
+
+        columns = get_id_columns(self.idpattern)
+        if len(columns) != 1 or \
+                columns[0] not in self.get_columns(schema, table):
+            self.log('Cannot split {}.{} without a single column primary '
+                     'key, reading it whole'.format(schema, table))
+            return None, max_value
+
+        lower, upper = self.get_min_max(schema, table, columns[0])
+        bounds = get_split_bounds(lower, upper, self.split_count)
+        return bounds and get_key_ranges(columns[0], bounds), max_value
+
+    def get_columns(self, schema: str, table: str) -> list:
+        key = (schema, table)
+        if key not in self.columns:
+            query = get_query(schema, table, '', '', None)
+            self.execute(get_columns_query(query))
+            self.columns[key] = [c[0] for c in
+                                 self.connector.cursor.description]
+
+        return self.columns[key]
+
+    def get_selected_columns(self, schema: str, table: str) -> (list, None):
+        """return the columns to select, leaving out the excluded ones so that
+        they're never read, None to select all of them. The columns of the
+        position key are always selected, see `get_hidden_columns`"""
+        if not self.excludes:
+            return None
+
+        columns = self.get_columns(schema, table)
+        hidden = self.get_hidden_columns()
+        selected = [c for c in columns
+                    if c not in self.excludes or c in hidden]
+        if len(selected) == len(columns):
+            return None
+
+        return selected
+
+    def get_min_max(self, schema: str, table: str, column: str,
+                    where: str = '') -> tuple:
+        self.execute(get_min_max_query(column, schema, table, where))
+        row = self.connector.cursor.fetchall()[0]
+
+        return row['min'], row['max']
+
+    def get_batch_size(self, name: str) -> int:
+        """return the number of rows to fetch from the table, so that a batch
+        fits in the byte budget and the fetch time target given its learned
+        row width and fetch rate"""
+        if not self.batch_bytes and not self.batch_latency:
+            return self.batch_size
+
+        width = self.row_widths.get(name)
+        rate = self.fetch_rates.get(name)
+        if (self.batch_bytes and not width) or \
+                (self.batch_latency and not rate):
+            # nothing learned yet, start with a small probe
+            return min(self.batch_size, PROBE_BATCH_SIZE)
+
+        sizes = []
+        if self.batch_bytes:
+            sizes.append(self.batch_bytes // width)
+        if self.batch_latency:
+            sizes.append(int(rate * self.batch_latency))
+
+        return max(MIN_BATCH_SIZE, min(min(sizes), MAX_BATCH_SIZE))
+
+    def learn_batch(self, name: str, rows: list, elapsed: float):
+        """update the row width and fetch rate of the table with the rows of
+        the last fetch"""
+        if not rows or (not self.batch_bytes and not self.batch_latency):
+            return
+
+        width = max(1, get_rows_size(rows) // len(rows))
+        previous = self.row_widths.get(name)
+        if previous:
+            # smooth it out, rows are not the same width across a table
+            width = int(previous * 0.7 + width * 0.3)
+        self.row_widths[name] = width
+        if elapsed > 0:
+            self.fetch_rates[name] = len(rows) / elapsed
+
+    def open_cursor(self, query: str):
+        """start reading the rows of the query with the selected engine"""
+        if self.engine == 'copy':
+            self.execute(get_columns_query(query))
+            description = self.connector.cursor.description
+            columns = [c[0] for c in description]
+            if self.row_format == 'columnar':
+                self.column_types = [c[1] for c in description]
+            if self.copy_format == 'binary':
+                types = [c[1] for c in description]
+                self.copy_reader = BinaryCopyReader(
+                    self.connector, query, columns, types, COPY_CHUNK_SIZE,
+                    self.parse_json)
+            else:
+                self.copy_reader = CopyReader(
+                    self.connector, query, columns, COPY_CHUNK_SIZE)
+            self.log(self.copy_reader.get_copy_query())
+            self.copy_reader.start()
+        else:
+            if self.row_format == 'columnar':
+                self.column_types = self.get_column_types(query)
+            self.execute('DECLARE cur CURSOR FOR {}'.format(query))
+            # spooled rows are kept as tuples, which are far more compact
+            if self.row_format != 'dict' or self.spool_dir:
+                self.row_cursor = self.connector.connection.cursor()
+
+    def get_column_types(self, query: str) -> list:
+        """return the type OIDs of the columns of the query"""
+        self.execute(get_columns_query(query))
+        return [c[1] for c in self.connector.cursor.description]
+
+    def get_xmin_where(self, schema: str, table: str,
+                       name: str) -> (str, None):
+        """return the condition of the rows changed since the table was last
+        read, and keep the current txid for the next time"""
+        self.execute(get_xmin_query(schema, table))
+        row = self.connector.cursor.fetchall()[0]
+        if not row['has_xmin']:
+            return None  # e.g. a view
+        if self.xmin_next is None:
+            self.xmin_next = row['xmin']
+
+        last = self.xmin_values.get(name)
+        if last is None:
+            return None
+
+        return get_xmin_clause(last, row['xmin'])
+
+    def get_keyset_key(self, schema: str, table: str) -> (list, None):
+        """return the columns by which the table is paged, the columns of
+        the `idpattern` or else the primary key of the table"""
+        key = get_id_columns(self.idpattern)
+        if key:
+            columns = self.get_columns(schema, table)
+            if any(k not in columns for k in key):
+                key = None
+        else:
+            self.execute(get_primary_key_query(schema, table))
+            key = [r['column'] for r in self.connector.cursor.fetchall()]
+        if not key:
+            self.log('Table "{}"."{}" has no primary key, reading it with '
+                     'a cursor'.format(schema, table))
+            return None
+
+        return key
+
+    def open_keyset(self, query_opts: dict):
+        """prepare the statements paging through the table in the order of
+        its key, each page is then read in its own short transaction instead
+        of holding a single snapshot for the whole table"""
+        key = self.keyset_key
+        position = get_keyset_clause(key)
+        where = query_opts['where']
+        where = '{} AND {}'.format(where, position) if where else position
+        first = get_query(**query_opts)
+        after = get_query(**dict(query_opts, where=where))
+        if self.row_format == 'columnar':
+            self.column_types = self.get_column_types(first)
+        self.execute('PREPARE keyset_first AS {} LIMIT $1'.format(first))
+        self.execute('PREPARE keyset_next AS {} LIMIT ${}'.format(
+            after, len(key) + 1))
+        self.connector.connection.commit()
+        self.keyset_position = self.last_value
+        if self.row_format != 'dict' or self.spool_dir:
+            self.row_cursor = self.connector.connection.cursor()
+
+    def fetch_keyset(self, batch_size: int) -> tuple:
+        """return the column names and the next page of the table"""
+        cursor = self.row_cursor or self.connector.cursor
+        if self.keyset_position is None:
+            self.execute('EXECUTE keyset_first (%s)', cursor, [batch_size])
+        else:
+            params = self.keyset_position + [batch_size]
+            self.execute('EXECUTE keyset_next ({})'.format(
+                ', '.join(['%s'] * len(params))), cursor, params)
+        rows = cursor.fetchall()
+        self.connector.connection.commit()
+
+        columns = None
+        if self.row_cursor is not None:
+            columns = [c[0] for c in cursor.description]
+        if rows:
+            last = rows[-1]
+            if columns is not None:
+                last = dict(zip(columns, last))
+            self.keyset_position = [last[k] for k in self.keyset_key]
+
+        return columns, rows
+
+    def fetch_batch(self, name: str, batch_size: int) -> tuple:
+        """fetch the next batch of the table and learn from it"""
+        fetch_start = time.perf_counter()
+        columns, rows = self.fetch(batch_size)
+        elapsed = time.perf_counter() - fetch_start
+        self.metrics.add(name, fetch_seconds=elapsed, fetches=1)
+        self.learn_batch(name, rows, elapsed)
+
+        return columns, rows
+
+    def fetch(self, batch_size: int) -> tuple:
+        """return the column names and the next `batch_size` rows of the
+        opened cursor. Column names are None when rows are dicts"""
+        if self.copy_reader is not None:
+            try:
+                rows = self.copy_reader.fetch(batch_size)
+            except psycopg2.DatabaseError as e:
+                # Same as `execute`, the retry should start a new connection,
+                # the rest of the table is closed by `read`
+                close_connection(self.connector)
+                print('Raise error {}'.format(e))
+                raise e
+            return self.copy_reader.columns, rows
+        if self.keyset_key:
+            return self.fetch_keyset(batch_size)
+
+        query = 'FETCH FORWARD {} FROM cur'.format(batch_size)
+        if self.row_cursor is not None:
+            self.execute(query, self.row_cursor)
+            columns = [c[0] for c in self.row_cursor.description]
+            return columns, self.row_cursor.fetchall()
+
+        self.execute(query)
+        return None, self.connector.cursor.fetchall()
+
+    def get_batch(self, columns: (list, None), rows: list,
+                  internals: dict) -> (list, Batch, ColumnBatch):
+        """return the rows with the internals added, either as a list of
+        dicts, as a `Batch` of tuples in the tuple row format or as a
+        `ColumnBatch` in the columnar format. The string fields are parsed
+        column by column, and only once a `Batch` is accessed"""
+        fields = self.string_fields
+        types = self.column_types
+        hidden = self.get_hidden_columns()
+        if hidden:
+            columns, rows, types = self.strip_columns(columns, rows, types,
+                                                      hidden)
+        if columns is None and self.row_format == 'columnar':
+            # a table opened before switching to the columnar format
+            columns = list(rows[0]) if rows else []
+            rows = [tuple(r.values()) for r in rows]
+        if columns is None:
+            result = [dict(r, **internals) for r in rows]
+            for field in fields:
+                if result and field in result[0]:
+                    values = parse_json([r[field] for r in result])
+                    for row, value in zip(result, values):
+                        row[field] = value
+            return result
+
+        parsed = [columns.index(f) for f in fields if f in columns]
+        if self.row_format == 'columnar':
+            types = types or [None] * len(columns)
+            batch = ColumnBatch.from_rows(list(zip(columns, types)), rows,
+                                          internals)
+            for i in parsed:
+                batch.columns[i] = parse_json(batch.columns[i])
+            return batch
+
+        batch = Batch(columns, rows, internals, parsed, parse_json)
+        if self.row_format == 'tuple':
+            return batch
+        if parsed:
+            return batch.to_dicts()
+        return [dict(zip(columns, r), **internals) for r in rows]
+
+    def get_hidden_columns(self) -> list:
+        """return the excluded columns of the position key, which are still
+        read for keeping track of the position inside the table but are left
+        out of the batches"""
+        key, _ = self.get_position_key()
+        return [k for k in key or [] if k in self.excludes]
+
+    @staticmethod
+    def strip_columns(columns: (list, None), rows: list,
+                      types: (list, None), names: list) -> tuple:
+        """return the columns, rows and column types without the `names`
+        columns"""
+        if columns is None:
+            rows = [{k: v for k, v in r.items() if k not in names}
+                    for r in rows]
+            return None, rows, types
+
+        keep = [i for i, c in enumerate(columns) if c not in names]
+        columns = [columns[i] for i in keep]
+        rows = [tuple(r[i] for i in keep) for r in rows]
+        if types:
+            types = [types[i] for i in keep]
+        return columns, rows, types
+
+    def close_table(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        self.close_scan()
+        self.column_types = None
+        self.keyset_key = None
+        self.keyset_position = None
+
+    def close_scan(self):
+        """stop reading the table from the DB and release its connection, a
+        spooled table is still served from its spool"""
+        if self.copy_reader is not None:
+            self.copy_reader.close()
+            self.copy_reader = None
+        self.row_cursor = None
+        if self.keyset_key and self.reuse_connections and \
+                self.connector.cursor is not None:
+            # prepared statements outlive the table on a reused connection
+            try:
+                self.connector.cursor.execute('DEALLOCATE ALL')
+            except psycopg2.Error:
+                pass
+        self.release_connection()
+
+    def resume_spool(self):
+        """serve the table from the spool of the state when it's still
+        there and complete, otherwise it's read from the DB again"""
+        path, self.spool_path = self.spool_path, None
+        if not self.spool_dir or not is_spool_path(path, self.spool_dir):
+            # only files of the spool directory are ever opened (or removed)
+            self.log('Ignoring spool {} of the state'.format(path))
+            return
+
+        self.spool = Spool.resume(path, self.spool_offset)
+        if self.spool is None:
+            self.log('Spool {} is gone or incomplete'.format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+
+        self.log('Resuming the table from spool {}'.format(path))
+        self.connector = Connector(cursor=None, connection=None)
+
+    def open_connection(self) -> Connector:
+        if self.reuse_connections:
+            connector = POOL.acquire(self.source)
+        else:
+            connector = connect(self.source)
+        if self.snapshot:
+            # must come first in the transaction of the connection
+            try:
+                connector.cursor.execute(SQL_SET_SNAPSHOT, [self.snapshot])
+            except psycopg2.errors.InvalidParameterValue:
+                # the coordinator transaction ended (e.g. its connection was
+                # lost), retrying in a new snapshot would mix the rows of two
+                close_connection(connector)
+                snapshot = self.snapshot
+                self.close_snapshot()
+                raise PostgresValidationError(
+                    'The snapshot {} of the tables is gone, they can\'t be '
+                    'read consistently'.format(snapshot))
+            except psycopg2.DatabaseError:
+                close_connection(connector)
+                raise
+        return connector
+
+    def export_snapshot(self):
+        """open the coordinator transaction and export its snapshot, for the
+        connections reading the tables to share it"""
+        self.coordinator = connect(self.source)
+        try:
+            self.coordinator.cursor.execute(SQL_EXPORT_SNAPSHOT)
+            self.snapshot = self.coordinator.cursor.fetchall()[0]['snapshot']
+        except psycopg2.DatabaseError:
+            self.close_snapshot()
+            raise
+        self.log('Reading the tables in snapshot {}'.format(self.snapshot))
+
+    def close_snapshot(self):
+        if self.coordinator is not None:
+            close_connection(self.coordinator)
+            self.coordinator = None
+        self.snapshot = None
+
+    def release_connection(self):
+        if self.reuse_connections:
+            POOL.release(self.source, self.connector)
+        else:
+            close_connection(self.connector)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.change_reader is not None:
+            self.change_reader.close()
+        if self.spool is not None and self.spool.drained and \
+                self.keep_spool:
+            # the reported state resumes the table from it
+            self.spool.close(remove=False)
+            self.spool = None
+        if self.connector is not None:
+            self.close_table()
+        self.close_snapshot()
+
+    def execute(self, query: str, cursor: object = None,
+                params: list = None):
         self.log(query, "Loaded: {}".format(self.connector.loaded))
+        # parameters are only passed to the statements that have them
+        args = (query,) if params is None else (query, params)
         try:
-            self.connector.cursor.execute(query)
+            (cursor or self.connector.cursor).execute(*args)
         except psycopg2.errors.UndefinedColumn as e:
             if self.inckey:
                 raise PostgresInckeyError(
@@ -146,16 +1039,72 @@ class Postgres(panoply.DataSource):
 
     def get_query_opts(self, schema: str, table: str,
                        max_value: Any = None) -> dict:
+        key, inclusive = self.get_position_key()
+        where = self.where
+        if self.xmin_where:
+            where = '{} AND {}'.format(where, self.xmin_where) if where \
+                else self.xmin_where
+        # the keyset engine passes the position to its prepared statement
+        if key and self.last_value is not None and not self.keyset_key:
+            # continue after the last row that was returned
+            position = get_position_clause(key, self.last_value, inclusive)
+            where = '{} AND {}'.format(where, position) if where else position
+
         query_opts = {
             'schema': schema,
             'table': table,
             'inckey': self.inckey,
             'incval': self.incval,
-            'max_value': max_value
+            'max_value': max_value,
+            'where': where,
+            'columns': self.get_selected_columns(schema, table),
+            'order': key
         }
 
         return query_opts
 
+    def get_position_key(self) -> tuple:
+        """return the columns by which tables are ordered, so that the last
+        row returned marks the position inside the table, and whether rows
+        at the same position may follow it (when the key isn't unique)"""
+        if self.keyset_key:
+            return self.keyset_key, False
+        if self.inckey:
+            return [self.inckey], True
+        if self.resume_by_key:
+            return get_id_columns(self.idpattern) or None, False
+        return None, False
+
+    def update_position(self, columns: (list, None), rows: list):
+        key, _ = self.get_position_key()
+        if not key or not rows:
+            return
+
+        last = rows[-1]
+        if columns is not None:
+            if any(k not in columns for k in key):
+                return
+            last = dict(zip(columns, last))
+        if any(last.get(k) is None for k in key):
+            return  # NULLs come last, stay at the last known position
+
+        self.last_value = [str(last[k]) for k in key]
+
+    def needs_max_value(self, schema: str, table: str) -> bool:
+        """whether the upper bound of the incremental key is looked up before
+        reading the table. Otherwise the rows are bounded by the snapshot of
+        the single statement reading them (the cursor or the COPY), which
+        the keyset engine doesn't have as it reads every page on its own"""
+        if self.max_value_mode == 'query' or self.engine == 'keyset':
+            return True
+        if not self.inckey or not self.incval:
+            return False  # the bound is only applied along with `incval`
+        if self.max_value_mode == 'stream':
+            return False
+
+        self.execute(get_index_query(schema, table, self.inckey))
+        return bool(self.connector.cursor.fetchall())
+
     def get_max_value(self, schema: str, table: str,
                       column: str) -> (Any, None):
         if not column:
@@ -170,4 +1119,59 @@ class Postgres(panoply.DataSource):
         state = {
             'last_index': current_index
         }
+        if self.completed:
+            state['completed'] = sorted(self.completed)
+        if self.batch_bytes and self.row_widths:
+            state['row_widths'] = dict(self.row_widths)
+        if self.last_value is not None:
+            state['last_value'] = self.last_value
+            state['rows_emitted'] = self.rows_emitted
+            if self.max_value is not None:
+                state['max_value'] = str(self.max_value)
+        if self.spool is not None:
+            state['spool_path'] = self.spool.path
+            state['spool_offset'] = self.spool.offset
+        if self.confirmed_lsn:
+            state['confirmed_lsn'] = self.confirmed_lsn
+        if self.plan:
+            state['plan'] = self.plan
+        if self.xmin_values:
+            state['xmin_values'] = dict(self.xmin_values)
+        if self.xmin_next is not None:
+            state['xmin_next'] = self.xmin_next
         self.state(self.state_id, state)
+
+
+class TableWorker(Postgres):
+    """Reads a single table on behalf of a `Postgres` stream running in
+    parallel mode. The worker never reports state or progress by itself, it is
+    up to the owning stream to do so for the batches it returns."""
+
+    def __init__(self, stream: Postgres, task: tuple, batch_size: int):
+        index, where, max_value = task
+        source = dict(stream.source)
+        source['data_available'] = [stream.tables[index]]
+        source['__concurrency'] = 1
+        source['__tableOrder'] = None  # planned by the stream
+        source['__splitMode'] = None  # split by the stream
+        super(TableWorker, self).__init__(source, stream.options)
+        self.batch_size = batch_size or self.batch_size
+        # shared so that the stream reports the widths learned by its workers
+        self.row_widths = stream.row_widths
+        self.metrics = stream.metrics
+        self.row_format = stream.row_format
+        self.snapshot = stream.snapshot
+        self.keep_spool = False  # there's no state to resume it from
+        # a range of a split table, all the ranges share the same max value
+        self.where = where
+        self.max_value = max_value
+
+    # errors are retried by the stream (or the scheduler) reading the table,
+    # not once more by the worker on top of that
+    read = Postgres.read.__wrapped__
+
+    def progress(self, *args):
+        pass
+
+    def _report_state(self, current_index: int):
+        pass
@@ -0,0 +1,84 @@
+import threading
+from collections import deque
+from typing import Callable
+
+from .utils import get_rows_size
+
+
+class Prefetcher:
+    """Keeps the next batches of a table in flight on a background thread.
+
+    `fetch` is called repeatedly on the background thread and must return
+    (columns, rows) tuples, an empty list of rows marks the end of the table.
+    Up to `depth` batches, and no more than `max_bytes` of them (at least one
+    batch is always allowed), are kept ahead of the consumer.
+    """
+
+    def __init__(self, fetch: Callable, depth: int, max_bytes: int = 0):
+        self.fetch = fetch
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.batches = deque()
+        self.size = 0
+        self.error = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def get(self) -> tuple:
+        """return the next (columns, rows) batch, waiting for it if it wasn't
+        fetched yet"""
+        with self.condition:
+            while not self.batches and not self.error:
+                self.condition.wait()
+            if not self.batches:
+                raise self.error
+
+            batch, size = self.batches.popleft()
+            self.size -= size
+            self.condition.notify_all()
+
+        return batch
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _full(self) -> bool:
+        if len(self.batches) >= self.depth:
+            return True
+        return bool(self.max_bytes and self.batches and
+                    self.size >= self.max_bytes)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self._full() and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+            try:
+                columns, rows = self.fetch()
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+            size = get_rows_size(rows) if self.max_bytes else 0
+            with self.condition:
+                self.batches.append(((columns, rows), size))
+                self.size += size
+                self.condition.notify_all()
+
+            if not rows:
+                return  # the end of the table
@@ -0,0 +1,212 @@
+import itertools
+import threading
+from collections import deque
+from typing import Dict, Iterable, Iterator
+
+import backoff
+import psycopg2
+
+from .dal.queries.consts import MAX_CONCURRENCY, HOST_CONNECTIONS, \
+    SCHEDULER_MAX_BYTES, MAX_RETRIES
+from .exceptions import PostgresValidationError
+from .postgresv2 import Postgres, TableWorker, _log_backoff, \
+    _get_connect_timeout
+from .utils import get_rows_size
+
+# workers don't retry their tables by themselves, the scheduler does
+_read = backoff.on_exception(backoff.expo,
+                             psycopg2.DatabaseError,
+                             max_tries=MAX_RETRIES,
+                             on_backoff=_log_backoff,
+                             base=_get_connect_timeout)(TableWorker.read)
+
+
+def get_host(source: Dict) -> str:
+    """return the host (and port) the source connects to"""
+    if 'addr' in source:
+        return source['addr'].split('/', 1)[0]
+    return '{}:{}'.format(source.get('host'), source.get('port'))
+
+
+class Scheduler:
+    """Reads the tables of many sources at once on a shared pool of threads.
+
+    Every source is a `Postgres` stream, each of its tables is read by a
+    `TableWorker` over its own connection. Up to `concurrency` tables are
+    read at once, and no more than `host_connections` of them from the same
+    host. The next table is taken from the source with the fewest tables
+    being read, the one served least recently on a tie, so that sources with
+    many tables don't hold back the others.
+
+    The batches fetched ahead of the consumer are limited to `max_bytes`
+    (estimated, at least one batch is always allowed). Batches are handed
+    back by `get()` along with their stream, which reports its state for
+    them the same way it does in parallel mode.
+    """
+
+    def __init__(self, sources: Iterable[tuple],
+                 concurrency: int = MAX_CONCURRENCY,
+                 host_connections: int = HOST_CONNECTIONS,
+                 max_bytes: int = SCHEDULER_MAX_BYTES):
+        self.streams = [Postgres(source, options)
+                        for source, options in sources]
+        for stream in self.streams:
+            if stream.slot:
+                raise PostgresValidationError(
+                    'The changes of replication slot "{}" can\'t be read by '
+                    'the scheduler'.format(stream.slot))
+            if stream.xmin_sync:
+                raise PostgresValidationError(
+                    'Syncing by xmin isn\'t supported by the scheduler')
+
+        self.concurrency = max(1, min(concurrency, MAX_CONCURRENCY))
+        self.host_connections = max(1, host_connections)
+        self.max_bytes = max_bytes
+        # the indexes of the tables left to read of each stream, the number
+        # of its tables being read and when it was last served
+        self.pending = []
+        for stream in self.streams:
+            indexes = [i for i in range(stream.index, len(stream.tables))
+                       if i not in stream.completed]
+            self.pending.append(deque(indexes))
+            stream.parts = {i: 1 for i in indexes}
+        self.remaining = sum(map(len, self.pending))
+        self.active = [0] * len(self.streams)
+        self.served = [0] * len(self.streams)
+        # the number of tables being read from each host
+        self.hosts = {}
+        self.order = itertools.count(1)
+        self.condition = threading.Condition()
+        # snapshots are exported once per stream, by the first of its tables
+        self.snapshot_lock = threading.Lock()
+
+        self.results = deque()
+        self.size = 0
+        self.stopped = False
+        self.threads = []
+
+    def __iter__(self) -> Iterator[tuple]:
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def start(self):
+        for _ in range(min(self.concurrency, self.remaining)):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def get(self) -> (tuple, None):
+        """return the next (stream, batch) pair, None once all the tables of
+        all the sources were read"""
+        if not self.threads and self.remaining:
+            self.start()
+
+        while True:
+            with self.condition:
+                while self.remaining and not self.results:
+                    self.condition.wait()
+                if not self.remaining:
+                    return None
+                stream, index, batch, size = self.results.popleft()
+                self.size -= size
+                if not batch:
+                    self.remaining -= 1
+                self.condition.notify_all()
+
+            if isinstance(batch, Exception):
+                self.close()
+                raise batch
+
+            stream.collect_batch(index, batch)
+            if stream.index >= len(stream.tables):
+                stream.close_snapshot()
+            if batch:
+                return stream, batch
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.results.clear()
+            self.size = 0
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for stream in self.streams:
+            stream.close_snapshot()
+
+    def _next_task(self) -> (tuple, None):
+        """wait for a table which can be read without going over the limit of
+        its host, None once there are none left"""
+        with self.condition:
+            while not self.stopped:
+                candidates = [
+                    i for i, stream in enumerate(self.streams)
+                    if self.pending[i] and self.hosts.get(
+                        get_host(stream.source), 0) < self.host_connections
+                ]
+                if candidates:
+                    i = min(candidates,
+                            key=lambda c: (self.active[c], self.served[c]))
+                    host = get_host(self.streams[i].source)
+                    self.hosts[host] = self.hosts.get(host, 0) + 1
+                    self.active[i] += 1
+                    self.served[i] = next(self.order)
+                    return i, self.pending[i].popleft()
+                if not any(self.pending):
+                    return None
+                self.condition.wait()
+
+        return None
+
+    def _task_done(self, i: int):
+        with self.condition:
+            self.hosts[get_host(self.streams[i].source)] -= 1
+            self.active[i] -= 1
+            self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+
+            i, index = task
+            stream = self.streams[i]
+            reader = None
+            try:
+                with self.snapshot_lock:
+                    if stream.consistent_snapshot and \
+                            stream.snapshot is None:
+                        stream.export_snapshot()
+                reader = TableWorker(stream, (index, None, None), None)
+                while not self.stopped:
+                    batch = _read(reader)
+                    if not batch:
+                        break
+                    self._put(stream, index, batch)
+                self._put(stream, index, [])
+            except Exception as e:
+                self._put(stream, index, e)
+                return
+            finally:
+                if reader is not None:
+                    reader.close()
+                self._task_done(i)
+
+    def _put(self, stream: Postgres, index: int, item):
+        """hand a batch over to the consumer, waiting while the batches ahead
+        of it are over the memory budget"""
+        size = 0 if isinstance(item, Exception) else get_rows_size(item)
+        with self.condition:
+            while not self.stopped and self.results and \
+                    self.size + size > self.max_bytes:
+                self.condition.wait()
+            if self.stopped:
+                return
+            self.results.append((stream, index, item, size))
+            self.size += size
+            self.condition.notify_all()
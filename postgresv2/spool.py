@@ -0,0 +1,191 @@
+import copyreg
+import io
+import os
+import pickle
+import re
+import stat
+import struct
+import threading
+import uuid
+import zlib
+from typing import Callable, IO
+
+from .dal.queries.consts import SPOOL_COMPRESSION
+
+# every frame is the length of its data followed by the compressed pickle of
+# a (columns, rows) batch, a frame of length 0 marks the end of the table
+FRAME_HEADER = struct.Struct('!I')
+END_FRAME = FRAME_HEADER.pack(0)
+SPOOL_NAME = re.compile(r'postgres-spool-[0-9a-f-]{36}\.bin$')
+
+
+def _load_memoryview(data: bytes, fmt: str) -> memoryview:
+    return memoryview(data).cast(fmt)
+
+
+class _Pickler(pickle.Pickler):
+    # bytea values are fetched as memoryviews, which can't be pickled
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[memoryview] = \
+        lambda m: (_load_memoryview, (m.tobytes(), m.format))
+
+
+def dump_frame(columns: list, rows: list) -> bytes:
+    buffer = io.BytesIO()
+    _Pickler(buffer, pickle.HIGHEST_PROTOCOL).dump((columns, rows))
+    data = zlib.compress(buffer.getbuffer(), SPOOL_COMPRESSION)
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def get_spool_path(directory: str) -> str:
+    return os.path.join(directory,
+                        'postgres-spool-{}.bin'.format(uuid.uuid4()))
+
+
+def is_spool_path(path: str, directory: str) -> bool:
+    """whether the path is the one of a spool file right in `directory`"""
+    return bool(SPOOL_NAME.match(os.path.basename(path))) and \
+        os.path.realpath(os.path.dirname(path)) == \
+        os.path.realpath(directory)
+
+
+def open_spool(path: str) -> (IO, None):
+    """open a spool file for reading, only when it's a regular file which
+    belongs to the current user and nobody else can access, as its frames
+    are unpickled"""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    f = os.fdopen(fd, 'rb')
+    info = os.fstat(fd)
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or \
+            info.st_mode & 0o077:
+        f.close()
+        return None
+
+    return f
+
+
+def is_complete(f: IO, offset: int = 0) -> bool:
+    """whether the frames of the spool file from `offset` on run up to the
+    end frame, i.e. the table was spooled to its end"""
+    size = os.fstat(f.fileno()).st_size
+    while offset + FRAME_HEADER.size <= size:
+        f.seek(offset)
+        length, = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+        offset += FRAME_HEADER.size + length
+        if not length:
+            return offset == size
+
+    return False
+
+
+class Spool:
+    """Drains the batches of a table into a local file on a background
+    thread, as fast as they're fetched, and serves them back from the file.
+
+    `fetch` is called repeatedly on the background thread and must return
+    (columns, rows) tuples, an empty list of rows marks the end of the table
+    after which the spool is `drained`, so that the transaction of the table
+    can end without waiting for a slow consumer. Batches are served in the
+    order they were fetched, `offset` is the position of the next one in the
+    file. The file can only be read by the current user.
+    """
+
+    def __init__(self, path: str, fetch: Callable = None):
+        self.path = path
+        self.fetch = fetch
+        # the offset of the next frame to serve, and the end of the frames
+        # written so far
+        self.offset = 0
+        self.end = 0
+        self.drained = False
+        self.error = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.writer = None
+        self.reader = None
+
+    @classmethod
+    def resume(cls, path: str, offset: int) -> ('Spool', None):
+        """serve the rest of a spool file which was already drained, None
+        when it's gone, incomplete or can't be trusted"""
+        reader = open_spool(path)
+        if reader is None:
+            return None
+        if not is_complete(reader, offset):
+            reader.close()
+            return None
+
+        spool = cls(path)
+        spool.reader = reader
+        spool.offset = offset
+        spool.end = os.fstat(reader.fileno()).st_size
+        spool.drained = True
+        return spool
+
+    def start(self):
+        # opened here, so that a bad directory fails the read right away
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        self.writer = os.fdopen(fd, 'wb')
+        self.reader = open(self.path, 'rb')
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def get(self) -> tuple:
+        """return the next (columns, rows) batch, waiting for it if it wasn't
+        spooled yet"""
+        with self.condition:
+            while self.offset >= self.end and not self.error:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+
+        self.reader.seek(self.offset)
+        length, = FRAME_HEADER.unpack(self.reader.read(FRAME_HEADER.size))
+        self.offset += FRAME_HEADER.size + length
+        if not length:
+            return None, []
+
+        return pickle.loads(zlib.decompress(self.reader.read(length)))
+
+    def close(self, remove: bool = True):
+        """stop spooling, and remove the file unless it's kept for resuming
+        from it"""
+        with self.condition:
+            self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for f in (self.writer, self.reader):
+            if f is not None:
+                f.close()
+        self.writer = self.reader = None
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _drain(self):
+        try:
+            while True:
+                with self.condition:
+                    if self.stopped:
+                        return
+                columns, rows = self.fetch()
+                frame = dump_frame(columns, rows) if rows else END_FRAME
+                self.writer.write(frame)
+                self.writer.flush()
+                with self.condition:
+                    self.end += len(frame)
+                    self.drained = not rows
+                    self.condition.notify_all()
+                if not rows:
+                    return
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
@@ -1,12 +1,15 @@
+import hashlib
 import re
-from typing import Dict
+import sys
+from typing import Dict, List
 
 import panoply
 import psycopg2
 from psycopg2.extras import RealDictRow
 
 from .dal.connector import Connector
-from .dal.queries.consts import CONNECT_TIMEOUT
+from .dal.queries.consts import CONNECT_TIMEOUT, ROW_SIZE_SAMPLE
+from .dal.types import register_profile, register_json_raw
 from .exceptions import PostgresValidationError
 
 
@@ -24,22 +27,79 @@ def format_table_name(row: RealDictRow) -> Dict:
     name = value
     name += f" ({table_types[row['table_type']]})"
 
-    return {'name': name, 'value': value}
+    formatted = {'name': name, 'value': value}
+    # estimated by the last ANALYZE, negative when it never ran
+    rows = row.get('estimated_rows')
+    if rows is not None and rows >= 0:
+        formatted['rows'] = rows
 
+    return formatted
+
+
+def get_rows_size(rows: list, sample: int = ROW_SIZE_SAMPLE) -> int:
+    """estimate the size in bytes of the values of the rows (dicts or
+    sequences) from an evenly spread sample of them"""
+    if not rows:
+        return 0
+
+    step = max(1, len(rows) // sample)
+    sampled = rows[::step]
+    size = 0
+    for row in sampled:
+        values = row.values() if isinstance(row, dict) else row
+        size += sum(map(sys.getsizeof, values))
+
+    return size * len(rows) // len(sampled)
+
+
+def get_id_columns(idpattern: str) -> List[str]:
+    """return the column names of a primary key pattern (e.g. `{id}`)"""
+    return re.findall(r'{([^}]+)}', idpattern or '')
+
+
+def get_excludes(source: Dict) -> List[str]:
+    """return the names of the columns excluded from the source"""
+    return get_names(source.get('excludes'))
+
+
+def get_string_fields(source: Dict) -> List[str]:
+    """return the names of the JSON text columns to parse (`stringFields`)"""
+    return get_names(source.get('stringFields'))
+
+
+def get_names(names: (list, str, None)) -> List[str]:
+    """return the column names of a list or a comma separated string"""
+    names = names or []
+    if isinstance(names, str):
+        names = names.split(',')
+    return [n.strip() for n in names if n.strip()]
 
-def connect(source: Dict) -> Connector:
-    """connect to the DB using properties from the source"""
+
+def get_dsn(source: Dict) -> str:
+    """return the partial DSN of the source"""
 
     # create partial DSN, user & pass still supplied as kwargs
     # as they're input separately from addr and will take precendence
     # over any user/pass from addr
     if 'addr' in source:
         # kept for backward compatibility
-        dsn = 'postgres://{}'.format(source['addr'])
-    else:
-        dsn = 'postgres://{}:{}/{}'.format(source['host'],
-                                           source['port'],
-                                           source['db_name'])
+        return 'postgres://{}'.format(source['addr'])
+
+    return 'postgres://{}:{}/{}'.format(source['host'],
+                                        source['port'],
+                                        source['db_name'])
+
+
+def get_credentials(source: Dict) -> tuple:
+    """return the user of the source along with a digest of its password,
+    for keeping the password itself out of long lived keys"""
+    password = str(source.get('password', '')).encode()
+    return source.get('username'), hashlib.sha256(password).hexdigest()
+
+
+def connect(source: Dict) -> Connector:
+    """connect to the DB using properties from the source"""
+    dsn = get_dsn(source)
 
     try:
         conn = psycopg2.connect(
@@ -48,6 +108,7 @@ def connect(source: Dict) -> Connector:
             password=source['password'],
             connect_timeout=CONNECT_TIMEOUT
         )
+        register_types(conn, source)
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     except psycopg2.OperationalError as e:
         if 'authentication failed' in str(e):
@@ -60,6 +121,26 @@ def connect(source: Dict) -> Connector:
     return Connector(connection=conn, cursor=cur)
 
 
+def connect_replication(source: Dict) -> Connector:
+    """open a logical replication connection to the DB, for streaming the
+    changes of a replication slot"""
+    conn = psycopg2.connect(
+        dsn=get_dsn(source),
+        user=source['username'],
+        password=source['password'],
+        connect_timeout=CONNECT_TIMEOUT,
+        connection_factory=psycopg2.extras.LogicalReplicationConnection
+    )
+    return Connector(connection=conn, cursor=conn.cursor())
+
+
+def register_types(connection: object, source: Dict):
+    """register the typecasters selected by the source on the connection"""
+    register_profile(connection, source.get('__typeProfile', 'default'))
+    if source.get('__parseJson'):
+        register_json_raw(connection)
+
+
 def close_connection(connector: Connector):
     """close the connection, and clear everything"""
     try:
@@ -71,6 +152,10 @@ def close_connection(connector: Connector):
             # implicitly
             connector.connection.rollback()
             connector.connection.close()
+    except psycopg2.InterfaceError:
+        # the connection was already closed (e.g. by the server), there's
+        # nothing left to clean up
+        pass
     finally:
         reset(connector)
 
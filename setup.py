@@ -22,7 +22,9 @@ setup(
             "pycodestyle==2.5.0",
             "coverage==4.3.4",
             "mock==2.0.0"
-        ]
+        ],
+        # a faster parser of the JSON string fields
+        "json": ["orjson==3.8.3"]
     },
 
     # place this package within the panoply package namespace
@@ -1,16 +1,44 @@
+import asyncio
+import datetime
+import os
+import struct
+import tempfile
+import threading
+import time
 import unittest
+from array import array
 from collections import OrderedDict
+from decimal import Decimal
 
 import mock
 import psycopg2
+import psycopg2.extras
 from panoply import PanoplyException
 
-from postgresv2.dal.queries.consts import MAX_RETRIES, CONNECT_TIMEOUT
-from postgresv2.dal.queries.query_builder import get_incremental, get_query
-from postgresv2.dynamic_params import get_tables
+from postgresv2.aio import AsyncPostgres
+from postgresv2.batch import Batch, ColumnBatch
+from postgresv2.dal.binary_copy import BinaryCopyReader, get_binary_query, \
+    decode_numeric, SIGNATURE
+from postgresv2.dal.copy_reader import parse_line
+from postgresv2.dal.pool import POOL
+from postgresv2.dal.types import NUMERIC_FLOAT, NUMERIC_FLOAT_ARRAY, RAW, \
+    JSON_RAW, JSON_RAW_ARRAY
+from postgresv2.dal.queries.consts import MAX_RETRIES, CONNECT_TIMEOUT, \
+    SQL_EXPORT_SNAPSHOT, SQL_SET_SNAPSHOT, CATALOG_TTL
+from postgresv2.dal.queries.query_builder import get_incremental, \
+    get_query, get_split_bounds, get_key_ranges, get_ctid_ranges, \
+    get_position_clause, get_xmin_clause
+from postgresv2 import dynamic_params
+from postgresv2.dynamic_params import get_tables, clear_tables_cache
 from postgresv2.exceptions import PostgresValidationError, PostgresInckeyError
+from postgresv2.metrics import Metrics
 from postgresv2.postgresv2 import Postgres
-from postgresv2.utils import connect, validate_host_and_port
+from postgresv2.prefetch import Prefetcher
+from postgresv2.scheduler import Scheduler
+from postgresv2.spool import END_FRAME, Spool, dump_frame, get_spool_path, \
+    is_complete, open_spool
+from postgresv2.utils import connect, validate_host_and_port, \
+    get_rows_size, close_connection
 
 OPTIONS = {
     "logger": lambda *msgs: None,  # no-op logger
@@ -26,6 +54,87 @@ def mock_max_value(*args):
     return None
 
 
+# pgoutput messages recorded from a replication slot, two rows inserted into
+# other.small, then one of them updated, the other deleted and the table
+# truncated, a transaction each
+RECORDED_CHANGES = [bytes.fromhex(m) for m in (
+    '420000000001f710700003012135654c430000030d',
+    '520000400b6f7468657200736d616c6c00660002016b0000000017ffffffff01760000'
+    '000019ffffffff',
+    '490000400b4e0002740000000131740000000161',
+    '490000400b4e0002740000000132740000000162',
+    '43000000000001f710700000000001f710a00003012135654c43',
+    '420000000001f710f80003012135654ef00000030e',
+    '550000400b4f00027400000001317400000001614e00027400000001317400000001'
+    '63',
+    '43000000000001f710f80000000001f711280003012135654ef0',
+    '420000000001f711700003012135654fea0000030f',
+    '440000400b4f0002740000000132740000000162',
+    '43000000000001f711700000000001f711a00003012135654fea',
+    '420000000001f719f0000301213565539100000310',
+    '520000400b6f7468657200736d616c6c00660002016b0000000017ffffffff01760000'
+    '000019ffffffff',
+    '5400000001000000400b',
+    '43000000000001f719f00000000001f71b000003012135655391',
+)]
+
+
+class ReplayCursor:
+    """A stand-in for the cursors of the connections reading a replication
+    slot, streams the recorded messages after the confirmed position"""
+
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.relations = {m[1:5]: m for m in messages if m[:1] == b'R'}
+        self.confirmed = 0  # index of the first message not confirmed
+        self.stream = []
+        self.wal_end = 0
+        self.result = []
+
+    def execute(self, query: str, params: list = None):
+        self.result = [{'lsn': '0/FFFFFFFF'}]
+
+    def fetchall(self) -> list:
+        return self.result
+
+    def start_replication(self, slot_name: str, decode: bool,
+                          start_lsn: int, options: dict):
+        # a new decoding session, relations are sent again before their
+        # first change
+        start = max(self.confirmed, self.get_index(start_lsn))
+        sent = set()
+        self.stream = []
+        for message in self.messages[start:]:
+            kind, oid = message[:1], message[1:5]
+            if kind in b'IUD' and oid not in sent:
+                self.stream.append(mock.Mock(payload=self.relations[oid]))
+            if kind in b'RIUD':
+                sent.add(oid)
+            self.stream.append(mock.Mock(payload=message))
+        self.wal_end = 0
+
+    def read_message(self) -> (object, None):
+        if self.stream:
+            return self.stream.pop(0)
+        # caught up with the server
+        self.wal_end = 0xFFFFFFFF
+        return None
+
+    def send_feedback(self, flush_lsn: int = 0, reply: bool = False):
+        self.confirmed = max(self.confirmed, self.get_index(flush_lsn))
+
+    def get_index(self, lsn: int) -> int:
+        """the index of the message after the commit ending at `lsn`"""
+        for i, message in enumerate(self.messages):
+            if message[:1] == b'C' and \
+                    struct.unpack_from('!Q', message, 10)[0] == lsn:
+                return i + 1
+        return 0
+
+    def close(self):
+        pass
+
+
 class TestPostgres(unittest.TestCase):
     def setUp(self):
         self.source = {
@@ -45,6 +154,8 @@ class TestPostgres(unittest.TestCase):
 
     def tearDown(self):
         self.source = None
+        POOL.clear()
+        clear_tables_cache()
 
     # fetches list of tables from database
     @mock.patch("psycopg2.connect")
@@ -77,6 +188,97 @@ class TestPostgres(unittest.TestCase):
             self.assertEqual(tables[x]['name'], mtable['name'])
             self.assertEqual(tables[x]['value'], v)
 
+    @mock.patch("psycopg2.connect")
+    def test_get_tables_filtered(self, mock_connect):
+        """lists a page of the tables starting with a prefix, and caches it
+        for the same source"""
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchall.return_value = [
+            {'table_schema': 'public', 'table_name': 'order_items',
+             'table_type': 'BASE TABLE', 'estimated_rows': 1200},
+            {'table_schema': 'public', 'table_name': 'orders',
+             'table_type': 'BASE TABLE', 'estimated_rows': -1},
+        ]
+        self.source['__tablesPrefix'] = 'public.order_'
+        self.source['__tablesLimit'] = 2
+
+        tables = get_tables(self.source)
+        self.assertEqual(get_tables(self.source), tables)
+
+        self.assertEqual(tables, [
+            {'name': 'public.order_items (table)',
+             'value': 'public.order_items', 'rows': 1200},
+            {'name': 'public.orders (table)', 'value': 'public.orders'},
+        ])
+        mock_connect.assert_called_once()
+        query, params = cursor.execute.call_args[0]
+        self.assertIn('LIKE %s', query)
+        self.assertTrue(query.endswith('ORDER BY 1, 2 LIMIT %s OFFSET %s'))
+        self.assertEqual(params, ['public.order\\_%', 'public.order\\_%',
+                                  2, 0])
+        # the password is only kept as a digest, and expired lists are
+        # evicted once another one is cached
+        key, = dynamic_params._tables_cache
+        self.assertNotIn(self.source['password'], key)
+        expired = time.monotonic() - CATALOG_TTL
+        dynamic_params._tables_cache[key] = (expired, [])
+        self.source['__tablesOffset'] = 2
+        get_tables(self.source)
+        self.assertNotIn(key, dynamic_params._tables_cache)
+        self.assertEqual(len(dynamic_params._tables_cache), 1)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_reuse_connections(self, mock_connect, _):
+        """the connection of the catalog listing is reused by the tables"""
+        connection = mock_connect.return_value
+        connection.closed = 0
+        connection.get_transaction_status.return_value = \
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        tables = [{'table_schema': 'public', 'table_name': 'foo',
+                   'table_type': 'BASE TABLE'}]
+        connection.cursor.return_value.fetchall.side_effect = \
+            [tables] + [self.mock_recs, []] * 3
+        self.source['__reuseConnections'] = True
+
+        tables = get_tables(self.source)
+        inst = Postgres(dict(self.source, data_available=tables * 3), OPTIONS)
+        while inst.read() is not None:
+            pass
+
+        mock_connect.assert_called_once()
+        connection.close.assert_not_called()
+        # every table starts in a fresh transaction
+        self.assertEqual(connection.rollback.call_count, 4)
+
+    @mock.patch("psycopg2.connect")
+    def test_reuse_connections_health(self, mock_connect):
+        """broken idle connections are replaced by new ones"""
+        broken, healthy = mock.MagicMock(closed=0), mock.MagicMock(closed=0)
+        mock_connect.side_effect = [broken, healthy]
+        broken.get_transaction_status.return_value = \
+            psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+
+        POOL.release(self.source, POOL.acquire(self.source))
+        connector = POOL.acquire(self.source)
+
+        self.assertIs(connector.connection, healthy)
+        broken.close.assert_called_once()
+
+    @mock.patch("psycopg2.connect")
+    def test_reuse_connections_credentials(self, mock_connect):
+        """connections aren't shared by sources with different passwords"""
+        connection = mock.MagicMock(closed=0)
+        connection.get_transaction_status.return_value = \
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        mock_connect.side_effect = [connection, psycopg2.OperationalError(
+            'password authentication failed')]
+
+        POOL.release(self.source, POOL.acquire(self.source))
+        with self.assertRaises(PanoplyException):
+            POOL.acquire(dict(self.source, password='wrong'))
+        self.assertIs(POOL.acquire(self.source).connection, connection)
+
     @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
     @mock.patch("psycopg2.connect")
     def test_read(self, mock_connect, _):
@@ -95,6 +297,76 @@ class TestPostgres(unittest.TestCase):
             self.assertEqual(rows[x]['__schemaname'], 'my_schema')
             self.assertEqual(rows[x]['__databasename'], self.source['db_name'])
 
+    @mock.patch("psycopg2.connect")
+    def test_read_async(self, mock_connect):
+        """the async stream reads the tables over async connections, and its
+        batches can be iterated with `async for`"""
+        connection = mock_connect.return_value
+        connection.poll.return_value = psycopg2.extensions.POLL_OK
+        cursor = connection.cursor.return_value
+        cursor.fetchall.side_effect = [
+            [{'max': 3}], self.mock_recs, [],
+            [{'max': 3}], self.mock_recs[:1], []
+        ]
+        self.source['data_available'] = [{'value': 'my_schema.foo_bar'},
+                                         {'value': 'my_schema.baz'}]
+        inst = AsyncPostgres(self.source, OPTIONS)
+        inst.state = mock.Mock()
+
+        async def read_all():
+            return [batch async for batch in inst]
+
+        batches = asyncio.run(read_all())
+        self.assertEqual([len(b) for b in batches], [3, 1])
+        self.assertEqual(batches[1][0]['__tablename'], 'baz')
+        self.assertEqual(mock_connect.call_args[1]['async_'], 1)
+        queries = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertEqual(queries[:3], [
+            'SELECT MAX("inckey") FROM "my_schema"."foo_bar"', 'BEGIN',
+            'DECLARE cur CURSOR FOR SELECT * FROM "my_schema"."foo_bar" '
+            'WHERE ("inckey" >= \'incval\' AND "inckey" <= \'3\') '
+            'ORDER BY "inckey"'])
+        self.assertEqual(inst.state.call_args[0][1], {'last_index': 1})
+        self.assertEqual(connection.close.call_count, 2)
+
+        with self.assertRaises(PostgresValidationError):
+            AsyncPostgres(dict(self.source, __engine='copy'), OPTIONS)
+
+        # the max value modes skip the MAX() query the same way
+        for mode, results in [('stream', [[]]), ('auto', [[], []])]:
+            cursor.reset_mock()
+            cursor.fetchall.side_effect = results
+            inst = AsyncPostgres(dict(self.source, __maxValueMode=mode),
+                                 OPTIONS)
+            asyncio.run(inst.read())
+            queries = [c[0][0] for c in cursor.execute.call_args_list]
+            self.assertFalse(any('MAX(' in q for q in queries))
+            self.assertEqual(any('pg_index' in q for q in queries),
+                             mode == 'auto')
+
+    @mock.patch("postgresv2.postgresv2.CONNECT_TIMEOUT", 0)
+    @mock.patch("postgresv2.aio.CONNECT_TIMEOUT", 0.01)
+    @mock.patch("psycopg2.connect")
+    def test_read_async_connect_timeout(self, mock_connect):
+        """connecting to a host which doesn't answer times out, and is
+        retried as any other connection error"""
+        connection = mock_connect.return_value
+        connection.poll.return_value = psycopg2.extensions.POLL_READ
+        # never readable
+        read_end, write_end = os.pipe()
+        connection.fileno.return_value = read_end
+        self.source['data_available'] = [{'value': 'my_schema.foo_bar'}]
+        inst = AsyncPostgres(self.source, OPTIONS)
+        try:
+            with self.assertRaises(psycopg2.OperationalError):
+                asyncio.run(inst.read())
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+
+        self.assertEqual(mock_connect.call_count, MAX_RETRIES)
+        self.assertEqual(connection.close.call_count, MAX_RETRIES)
+
     @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
     @mock.patch("psycopg2.connect")
     def test_read_from_other_schema(self, mock_connect, __):
@@ -137,6 +409,37 @@ class TestPostgres(unittest.TestCase):
         execute_mock = mock_connect.return_value.cursor.return_value.execute
         execute_mock.assert_has_calls([mock.call(q)], True)
 
+    @mock.patch("psycopg2.connect")
+    def test_max_value_modes(self, mock_connect):
+        """the MAX() of the incremental key is only queried when it's indexed
+        in the auto mode, and never in the stream mode"""
+        cursor = mock_connect.return_value.cursor.return_value
+        unbounded = ('DECLARE cur CURSOR FOR SELECT * FROM "schema"."foo" '
+                     'WHERE "inckey" >= \'incval\' ORDER BY "inckey"')
+        bounded = ('DECLARE cur CURSOR FOR SELECT * FROM "schema"."foo" '
+                   'WHERE ("inckey" >= \'incval\' AND "inckey" <= \'9\') '
+                   'ORDER BY "inckey"')
+
+        for mode, results, expected in [
+                ('stream', [[]], unbounded),
+                ('auto', [[], []], unbounded),
+                ('auto', [[{'?column?': 1}], [{'max': 9}], []], bounded)]:
+            cursor.reset_mock()
+            cursor.fetchall.side_effect = results
+            inst = Postgres(dict(self.source, __maxValueMode=mode), OPTIONS)
+            inst.tables = [{'value': 'schema.foo'}]
+            inst.read()
+
+            queries = [c[0][0] for c in cursor.execute.call_args_list]
+            self.assertEqual(queries[-2], expected)
+            self.assertEqual(any('MAX(' in q for q in queries),
+                             expected == bounded)
+            self.assertEqual(any('pg_index' in q for q in queries),
+                             mode == 'auto')
+
+        with self.assertRaises(PostgresValidationError):
+            Postgres(dict(self.source, __maxValueMode='other'), OPTIONS)
+
     @mock.patch("psycopg2.connect")
     def test_schema_name(self, mock_connect):
         """Test schema name is used when queries and that both schema and table
@@ -159,6 +462,21 @@ class TestPostgres(unittest.TestCase):
         execute_mock = mock_connect.return_value.cursor.return_value.execute
         execute_mock.assert_has_calls([mock.call(q)], True)
 
+    @mock.patch("psycopg2.connect")
+    def test_excludes_projection(self, mock_connect):
+        """excluded columns are left out of the query"""
+        self.source['excludes'] = ['col2', 'unknown']
+        self.source['inckey'] = ''
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'schema.foo'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.description = [('id',), ('col1',), ('col2',)]
+        inst.read()
+
+        q = 'DECLARE cur CURSOR FOR SELECT "id", "col1" FROM "schema"."foo"'
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q)], True)
+
     @mock.patch("psycopg2.connect")
     def test_connect_auth_error(self, mock_connect):
         msg = 'authentication failed'
@@ -223,6 +541,28 @@ class TestPostgres(unittest.TestCase):
             connect_timeout=CONNECT_TIMEOUT
         )
 
+    @mock.patch("psycopg2.extensions.register_type")
+    @mock.patch("psycopg2.connect")
+    def test_type_profiles(self, mock_connect, mock_register):
+        """registers the typecasters of the profile on the connection"""
+        source = dict(self.source, __typeProfile='typed')
+        connect(source)
+        registered = [c[0][0] for c in mock_register.call_args_list]
+        self.assertEqual(registered, [NUMERIC_FLOAT, NUMERIC_FLOAT_ARRAY])
+        self.assertEqual(mock_register.call_args[0][1],
+                         mock_connect.return_value)
+
+        mock_register.reset_mock()
+        connect(self.source)
+        mock_register.assert_not_called()
+
+        self.assertEqual(RAW('1.50', None), '1.50')
+        self.assertEqual(RAW('{1,2}', None), '{1,2}')
+        self.assertEqual(NUMERIC_FLOAT('1.5', None), 1.5)
+        self.assertEqual(NUMERIC_FLOAT_ARRAY('{1.5,NULL}', None), [1.5, None])
+        with self.assertRaises(PostgresValidationError):
+            Postgres(dict(self.source, __typeProfile='other'), OPTIONS)
+
     @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
     @mock.patch("postgresv2.postgresv2.Postgres.execute")
     @mock.patch("psycopg2.connect")
@@ -391,6 +731,314 @@ class TestPostgres(unittest.TestCase):
                         first_query)
         self.assertTrue('FROM "public"."test2"' in first_query)
 
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_reports_position(self, mock_connect, mock_state):
+        """the state records the position inside the table, which is where a
+        retry continues from"""
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.test1'}]
+        inst.max_value = 100
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = [
+            {'id': 1, 'inckey': 5},
+            {'id': 2, 'inckey': 7},
+        ]
+
+        inst.read()
+        state = {
+            'last_index': 0,
+            'last_value': ['7'],
+            'rows_emitted': 2,
+            'max_value': '100'
+        }
+        mock_state.assert_called_with(inst.state_id, state)
+
+        # the connection is lost, the retry continues from the position
+        close_connection(inst.connector)
+        inst.read()
+        q = ('DECLARE cur CURSOR FOR SELECT * FROM "public"."test1" '
+             'WHERE ("inckey" >= \'incval\' AND "inckey" <= \'100\') '
+             'AND ("inckey" >= \'7\' OR "inckey" IS NULL) '
+             'ORDER BY "inckey"')
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q)], True)
+
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_read_changes(self, mock_connect, mock_state):
+        """streams the changes of the replication slot, which are only
+        confirmed by the next stream resumed from the saved state"""
+        self.source['__replicationSlot'] = 'panoply'
+        self.source['__publication'] = 'panoply'
+        slot = ReplayCursor(RECORDED_CHANGES)
+        mock_connect.return_value.cursor.return_value = slot
+        inst = Postgres(self.source, OPTIONS)
+
+        changes = []
+        batch = inst.read(5)
+        while batch is not None:
+            changes.append([(r['__op'], r.get('k'), r.get('v'))
+                            for r in batch])
+            batch = inst.read(5)
+
+        self.assertEqual(changes, [
+            [('insert', 1, 'a'), ('insert', 2, 'b')],
+            [('update', 1, 'c'), ('delete', 2, 'b')],
+            [('truncate', None, None)],
+        ])
+        mock_state.assert_called_with(inst.state_id, {
+            'last_index': 0,
+            'confirmed_lsn': '0/1F71B00'
+        })
+        self.assertEqual(slot.confirmed, 0)
+        self.assertEqual(
+            mock_connect.call_args[1]['connection_factory'],
+            psycopg2.extras.LogicalReplicationConnection)
+
+        # a new stream confirms the position of the state, and continues
+        # after it, from a new connection on retries
+        self.source['state'] = {'confirmed_lsn': '0/1F71128'}
+        inst = Postgres(self.source, OPTIONS)
+        self.assertEqual([r['__op'] for r in inst.read(3)], ['delete'])
+        self.assertEqual(slot.confirmed, 8)
+        inst.connector.cursor = None
+        self.assertEqual([r['__op'] for r in inst.read(3)], ['truncate'])
+        self.assertIsNone(inst.read(3))
+        self.assertEqual(slot.confirmed, 8)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_metrics(self, mock_connect, _):
+        """hands the metrics of each batch and table to the hook, and writes
+        them to a Prometheus textfile"""
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchall.side_effect = [self.mock_recs, []]
+        events = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'postgres.prom')
+            self.source['__metricsFile'] = path
+            options = dict(OPTIONS, metrics=events.append)
+            inst = Postgres(self.source, options)
+            inst.tables = [{'value': 'public.test1'}]
+            while inst.read() is not None:
+                pass
+
+            with open(path) as f:
+                textfile = f.read()
+
+        self.assertEqual([(e['event'], e['rows']) for e in events],
+                         [('batch', 3), ('batch', 0), ('table', 3)])
+        self.assertEqual(events[-1]['fetches'], 2)
+        self.assertGreater(events[-1]['bytes'], 0)
+        self.assertIn('# TYPE postgres_source_rows_total counter\n'
+                      'postgres_source_rows_total{table="public.test1"} 3\n',
+                      textfile)
+
+    def test_metrics_concurrent(self):
+        """tables completed by several threads at once write the textfile
+        one after the other"""
+        errors = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'postgres.prom')
+            metrics = Metrics(path=path)
+            barrier = threading.Barrier(8)
+
+            def complete(i):
+                barrier.wait()
+                try:
+                    for j in range(20):
+                        table = 'public.t{}_{}'.format(i, j)
+                        metrics.add(table, rows=1)
+                        metrics.table_done(table)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=complete, args=(i,))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            with open(path) as f:
+                textfile = f.read()
+            self.assertEqual(os.listdir(tmp), ['postgres.prom'])
+
+        self.assertEqual(errors, [])
+        self.assertEqual(textfile.count('postgres_source_rows_total{'), 160)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("postgresv2.postgresv2.Postgres.progress")
+    @mock.patch("psycopg2.connect")
+    def test_plan_tables(self, mock_connect, mock_progress, _):
+        """reads the largest tables first, reporting the progress in rows"""
+        self.source['__tableOrder'] = 'largest'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.small'}, {'value': 'public.big'}]
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchall.side_effect = [
+            [{'table': 'public.small', 'rows': 3, 'bytes': 8192},
+             {'table': 'public.big', 'rows': 6, 'bytes': 2 ** 20}],
+            self.mock_recs, [], self.mock_recs, [],
+        ]
+
+        while inst.read() is not None:
+            pass
+
+        self.assertEqual(inst.plan, ['public.big', 'public.small'])
+        self.assertEqual([c[0][:2] for c in mock_progress.call_args_list],
+                         [(0, 9), (3, 9), (6, 9), (9, 9)])
+        self.assertIn('FROM "public"."big"',
+                      cursor.execute.call_args_list[1][0][0])
+
+        # a resumed plan is kept even once the tables aren't planned anymore
+        self.source['__tableOrder'] = None
+        self.source['data_available'] = [
+            {'value': 'public.small'}, {'value': 'public.big'}]
+        self.source['state'] = {'last_index': 1, 'completed': [],
+                                'plan': ['public.big', 'public.small']}
+        cursor.fetchall.side_effect = [self.mock_recs, []]
+        inst = Postgres(self.source, OPTIONS)
+        self.assertEqual(inst.tables[inst.index]['value'], 'public.small')
+        inst.read()
+        self.assertIn('FROM "public"."small"',
+                      cursor.execute.call_args_list[-2][0][0])
+
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_xmin_sync(self, mock_connect, mock_state):
+        """reads the rows changed since the txid of the last sync"""
+        self.source['inckey'] = ''
+        self.source['__xminSync'] = True
+        self.source['state'] = {
+            'last_index': 2,
+            'xmin_values': {'public.test1': 700}
+        }
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.test1'}, {'value': 'public.test2'}]
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchall.side_effect = [
+            [{'xmin': 800, 'has_xmin': True}], self.mock_recs, [],
+            [{'xmin': 900, 'has_xmin': True}], self.mock_recs, [],
+        ]
+
+        batches = []
+        batch = inst.read()
+        while batch is not None:
+            batches.append(batch)
+            batch = inst.read()
+
+        cursor.execute.assert_has_calls([
+            mock.call('DECLARE cur CURSOR FOR SELECT * FROM "public"."test1" '
+                      'WHERE xmin::text::bigint >= 700'),
+            mock.call('DECLARE cur CURSOR FOR SELECT * FROM "public"."test2"'),
+        ], True)
+        mock_state.assert_called_with(inst.state_id, {
+            'last_index': 2,
+            'xmin_values': {'public.test1': 800, 'public.test2': 900}
+        })
+        # the last watermark is committed along with the last rows
+        self.assertEqual(batches[-2][0]['__state'], inst.state_id)
+
+        self.source['__concurrency'] = 2
+        with self.assertRaises(PostgresValidationError):
+            Postgres(self.source, OPTIONS)
+        with self.assertRaises(PostgresValidationError):
+            Scheduler([(dict(self.source, __concurrency=1), OPTIONS)])
+
+    def test_xmin_clause(self):
+        """the txids after a wraparound are below the current txid"""
+        epoch = 1 << 32
+        self.assertEqual(get_xmin_clause(epoch + 700, epoch + 800),
+                         'xmin::text::bigint >= 700')
+        self.assertEqual(get_xmin_clause(epoch - 100, epoch + 800),
+                         '(xmin::text::bigint >= 4294967196 OR '
+                         'xmin::text::bigint < 800)')
+        self.assertIsNone(get_xmin_clause(700, 2 * epoch + 800))
+
+    @mock.patch("psycopg2.connect")
+    def test_keyset_engine(self, mock_connect):
+        """pages through the table by its primary key, a transaction per
+        page"""
+        self.source['inckey'] = ''
+        self.source['__engine'] = 'keyset'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.test1'}]
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchall.side_effect = [
+            [{'column': 'id'}], self.mock_recs[:2], self.mock_recs[2:], []]
+
+        rows = []
+        batch = inst.read(2)
+        while batch:
+            rows.extend(batch)
+            batch = inst.read(2)
+
+        self.assertEqual([r['id'] for r in rows], [1, 2, 3])
+        cursor.execute.assert_has_calls([
+            mock.call('PREPARE keyset_first AS SELECT * FROM "public"."test1"'
+                      ' ORDER BY "id" LIMIT $1'),
+            mock.call('PREPARE keyset_next AS SELECT * FROM "public"."test1"'
+                      ' WHERE ("id") > ($1) ORDER BY "id" LIMIT $2'),
+            mock.call('EXECUTE keyset_first (%s)', [2]),
+            mock.call('EXECUTE keyset_next (%s, %s)', [2, 2]),
+            mock.call('EXECUTE keyset_next (%s, %s)', [3, 2]),
+        ])
+        self.assertEqual(mock_connect.return_value.commit.call_count, 4)
+
+    @mock.patch("psycopg2.connect")
+    def test_keyset_excluded_key(self, mock_connect):
+        """an excluded key column is still read for paging through the
+        table, and left out of the rows"""
+        self.source['inckey'] = ''
+        self.source['__engine'] = 'keyset'
+        self.source['excludes'] = ['id', 'col2']
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.test1'}]
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [('id',), ('col1',), ('col2',)]
+        rows = [{'id': r['id'], 'col1': r['col1']} for r in self.mock_recs]
+        cursor.fetchall.side_effect = [
+            [{'column': 'id'}], rows[:2], rows[2:], []]
+
+        batch = inst.read(2)
+        self.assertEqual([r['col1'] for r in batch], ['foo1', 'foo2'])
+        self.assertNotIn('id', batch[0])
+        self.assertEqual(inst.keyset_position, [2])
+        self.assertEqual([r['col1'] for r in inst.read(2)], ['foo3'])
+        cursor.execute.assert_has_calls([
+            mock.call('PREPARE keyset_first AS SELECT "id", "col1" FROM '
+                      '"public"."test1" ORDER BY "id" LIMIT $1'),
+            mock.call('EXECUTE keyset_next (%s, %s)', [2, 2]),
+        ], True)
+
+    @mock.patch("postgresv2.postgresv2.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_recover_from_position(self, mock_connect, mock_execute):
+        """continues to read a table from the position saved in the state"""
+        self.source['inckey'] = ''
+        self.source['idpattern'] = '{id}-{id2}'
+        self.source['__resumeByPrimaryKey'] = True
+        self.source['state'] = {
+            'last_index': 1,
+            'last_value': ['101', 'a'],
+            'rows_emitted': 5000
+        }
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.test1'}, {'value': 'public.test2'}]
+        self.assertEqual(inst.rows_emitted, 5000)
+
+        inst.read()
+        query = mock_execute.call_args_list[0][0][0]
+        self.assertEqual(query, 'DECLARE cur CURSOR FOR SELECT * FROM '
+                                '"public"."test2" WHERE ("id", "id2") > '
+                                '(\'101\', \'a\') ORDER BY "id", "id2"')
+
+    def test_position_clause(self):
+        self.assertEqual(get_position_clause(['id'], ["it's"], False),
+                         '"id" > \'it\'\'s\'')
+
     def test_remove_state_from_source(self):
         """ once extracted, the state object is removed from the source """
         last_index = 3
@@ -421,6 +1069,173 @@ class TestPostgres(unittest.TestCase):
         txt = 'FETCH FORWARD {}'.format(customBatchSize)
         self.assertTrue(second_query.startswith(txt))
 
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch("postgresv2.postgresv2.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_batch_bytes(self, mock_connect, mock_execute, mock_state, _):
+        """batches are sized by bytes once the row width of a table is
+        learned, and the width is kept in the state for the next run"""
+        self.source['__batchBytes'] = 1000000
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = self.mock_recs
+        width = get_rows_size(self.mock_recs) // len(self.mock_recs)
+
+        inst.read()
+        inst.read()
+        queries = [c[0][0] for c in mock_execute.call_args_list]
+        self.assertEqual(queries[1], 'FETCH FORWARD 500 FROM cur')
+        self.assertEqual(queries[2],
+                         'FETCH FORWARD {} FROM cur'.format(1000000 // width))
+
+        state = mock_state.call_args[0][1]
+        self.assertEqual(state['row_widths'], {'my_schema.foo_bar': width})
+
+        # the next run starts with the learned width
+        self.source['state'] = state
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        inst.read()
+        self.assertEqual(mock_execute.call_args[0][0],
+                         'FETCH FORWARD {} FROM cur'.format(1000000 // width))
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_read_prefetch(self, mock_connect, _):
+        """batches are fetched ahead on a background thread"""
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            self.mock_recs[:2], self.mock_recs[2:], []
+        ]
+        self.source['__prefetch'] = 2
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+        self.assertEqual([r['id'] for r in inst.read()], [1, 2])
+        self.assertEqual([r['id'] for r in inst.read()], [3])
+        self.assertEqual(inst.read(), [])
+        self.assertIsNone(inst.prefetcher)
+        self.assertIsNone(inst.read())
+
+    def test_prefetcher_limits(self):
+        """no more than `depth` batches are fetched ahead, and errors are
+        raised to the consumer"""
+        batches = iter([(None, [1]), (None, [2]), (None, [3])])
+        fetch = mock.Mock(side_effect=lambda: next(batches))
+        prefetcher = Prefetcher(fetch, 2)
+        prefetcher.start()
+        self.assertEqual(prefetcher.get(), (None, [1]))
+        prefetcher.close()
+        self.assertLessEqual(fetch.call_count, 3)
+
+        fetch = mock.Mock(side_effect=psycopg2.DatabaseError('oh noes!'))
+        prefetcher = Prefetcher(fetch, 2)
+        prefetcher.start()
+        with self.assertRaises(psycopg2.DatabaseError):
+            prefetcher.get()
+        prefetcher.close()
+
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_read_spool(self, mock_connect, _, mock_state):
+        """tables are drained into a spool file, the connection is released
+        once they're fetched and the batches are served from the file"""
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [('id',), ('col1',), ('col2',)]
+        rows = [tuple(r.values()) for r in self.mock_recs]
+        cursor.fetchall.side_effect = [rows[:2], rows[2:], []]
+        with tempfile.TemporaryDirectory() as tmp:
+            self.source['__spool'] = True
+            self.source['__spoolDir'] = tmp
+            inst = Postgres(self.source, OPTIONS)
+            inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+            self.assertEqual([r['id'] for r in inst.read()], [1, 2])
+            state = mock_state.call_args[0][1]
+            self.assertEqual(os.path.dirname(state['spool_path']), tmp)
+            self.assertGreater(state['spool_offset'], 0)
+            inst.spool.thread.join()
+            self.assertEqual([r['id'] for r in inst.read()], [3])
+            # the whole table was fetched, its transaction has ended
+            mock_connect.return_value.close.assert_called_once()
+            self.assertEqual(inst.read(), [])
+            self.assertIsNone(inst.spool)
+            self.assertEqual(os.listdir(tmp), [])
+
+        self.source['__prefetch'] = 2
+        with self.assertRaises(PostgresValidationError):
+            Postgres(self.source, OPTIONS)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_resume_spool(self, mock_connect, _):
+        """a stream resumed from the state of a spooled table serves the rest
+        of it from the spool file, or from the DB when the file is
+        incomplete, can't be trusted or isn't in the spool directory"""
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [('id',), ('col1',), ('col2',)]
+        cursor.fetchall.side_effect = [[(3, 'foo3', 'bar3')], []] * 3
+        rows = [(1, memoryview(b'\x01')), (2, None)]
+        batches = iter([(['id', 'raw'], rows[:1]), (['id', 'raw'], rows[1:]),
+                        (None, [])])
+        with tempfile.TemporaryDirectory() as tmp:
+            self.source['__spool'] = True
+            self.source['__spoolDir'] = tmp
+            path = get_spool_path(tmp)
+            spool = Spool(path, lambda: next(batches))
+            spool.start()
+            self.assertEqual(spool.get(), (['id', 'raw'], rows[:1]))
+            spool.thread.join()
+            spool.close(remove=False)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            with open_spool(path) as f:
+                self.assertTrue(is_complete(f, spool.offset))
+
+            self.source['state'] = {'last_index': 0, 'spool_path': path,
+                                    'spool_offset': spool.offset}
+            inst = Postgres(self.source, OPTIONS)
+            inst.tables = [{'value': 'my_schema.foo_bar'}]
+            self.assertEqual([r['id'] for r in inst.read()], [2])
+            self.assertEqual(inst.read(), [])
+            mock_connect.assert_not_called()
+            self.assertFalse(os.path.exists(path))
+
+            def resume(path: str):
+                self.source['state'] = {'last_index': 0, 'spool_path': path}
+                inst = Postgres(self.source, OPTIONS)
+                inst.tables = [{'value': 'my_schema.foo_bar'}]
+                self.assertEqual([r['id'] for r in inst.read()], [3])
+                inst.close()
+
+            # a partly written spool is read from the DB again
+            with open(path, 'wb') as f:
+                f.write(dump_frame(['id', 'raw'], rows))
+            os.chmod(path, 0o600)
+            with open_spool(path) as f:
+                self.assertFalse(is_complete(f))
+            resume(path)
+            self.assertFalse(os.path.exists(path))
+
+            # and so is a spool other users can access
+            with open(path, 'wb') as f:
+                f.write(END_FRAME)
+            os.chmod(path, 0o644)
+            self.assertIsNone(open_spool(path))
+            resume(path)
+
+            # files out of the spool directory are left alone
+            other = os.path.join(tmp, 'other')
+            os.mkdir(other)
+            path = get_spool_path(other)
+            with open(path, 'wb') as f:
+                f.write(END_FRAME)
+            resume(path)
+            self.assertTrue(os.path.exists(path))
+
     def test_reset_query_on_error(self):
         inst = Postgres(self.source, OPTIONS)
         mock_connector = mock.Mock()
@@ -446,6 +1261,505 @@ class TestPostgres(unittest.TestCase):
 
         self.assertEqual(mock_connect.call_count, MAX_RETRIES)
 
+    @mock.patch("postgresv2.postgresv2.CONNECT_TIMEOUT", 0)
+    @mock.patch("psycopg2.connect")
+    def test_read_parallel_retries(self, mock_connect):
+        """the tables read in parallel are only retried by the stream, not
+        once more by each of its workers"""
+        self.source['__concurrency'] = 2
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.table1'}]
+        mock_connect.side_effect = psycopg2.DatabaseError('TestRetriesError')
+        with self.assertRaises(psycopg2.DatabaseError):
+            inst.read()
+
+        self.assertEqual(mock_connect.call_count, MAX_RETRIES)
+        self.assertIsNone(inst.pool)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_read_parallel(self, mock_connect, mock_state, _):
+        """reads several tables concurrently, each over its own connection,
+        and tags every batch with the table it was read from"""
+
+        def new_connection(*args, **kwargs):
+            conn = mock.MagicMock()
+            conn.cursor.return_value.fetchall.side_effect = [
+                [dict(r) for r in self.mock_recs], []
+            ]
+            return conn
+
+        mock_connect.side_effect = new_connection
+        self.source['__concurrency'] = 2
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [
+            {'value': 'public.table1'},
+            {'value': 'public.table2'},
+            {'value': 'other.table3'},
+        ]
+
+        tables = set()
+        result = inst.read()
+        while result is not None:
+            for row in result:
+                tables.add((row['__schemaname'], row['__tablename']))
+            result = inst.read()
+
+        expected = {('public', 'table1'), ('public', 'table2'),
+                    ('other', 'table3')}
+        self.assertEqual(tables, expected)
+        self.assertEqual(mock_connect.call_count, 3)
+        self.assertEqual(inst.index, 3)
+        self.assertEqual(mock_state.call_count, 3)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_scheduler(self, mock_connect, mock_state, _):
+        """reads the tables of several sources at once, within the limit of
+        connections of each host, and reports the state of each source"""
+        lock = threading.Lock()
+        active = {}
+        peak = {}
+
+        def close(dsn):
+            with lock:
+                active[dsn] -= 1
+
+        def new_connection(dsn, **kwargs):
+            with lock:
+                active[dsn] = active.get(dsn, 0) + 1
+                peak[dsn] = max(peak.get(dsn, 0), active[dsn])
+            conn = mock.MagicMock()
+            conn.cursor.return_value.fetchall.side_effect = [
+                [dict(r) for r in self.mock_recs], []
+            ]
+            conn.close.side_effect = lambda: close(dsn)
+            return conn
+
+        mock_connect.side_effect = new_connection
+        tables = [{'value': 'public.table1'}, {'value': 'public.table2'}]
+        sources = [
+            dict(self.source, data_available=tables),
+            dict(self.source, data_available=tables),
+            dict(self.source, host='other.host', data_available=tables[:1]),
+        ]
+        scheduler = Scheduler([(s, OPTIONS) for s in sources],
+                              concurrency=4, host_connections=1, max_bytes=1)
+
+        read = [(stream, batch[0]['__tablename']) for stream, batch
+                in scheduler]
+        streams = scheduler.streams
+        self.assertEqual(sorted((streams.index(s), t) for s, t in read), [
+            (0, 'table1'), (0, 'table2'), (1, 'table1'), (1, 'table2'),
+            (2, 'table1')])
+        self.assertEqual(set(peak.values()), {1})
+        self.assertEqual([s.index for s in streams], [2, 2, 1])
+        self.assertEqual(mock_state.call_count, 5)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_consistent_snapshot(self, mock_connect, _):
+        """the tables are read in the snapshot exported by a coordinator
+        connection, which is closed once they're all read"""
+        coordinator = mock.MagicMock()
+        coordinator.cursor.return_value.fetchall.return_value = [
+            {'snapshot': '00000003-0000001B-1'}]
+        readers = []
+
+        def new_connection(*args, **kwargs):
+            if mock_connect.call_count == 1:
+                return coordinator
+            conn = mock.MagicMock()
+            conn.cursor.return_value.fetchall.side_effect = [
+                [dict(r) for r in self.mock_recs], []
+            ]
+            readers.append(conn)
+            return conn
+
+        mock_connect.side_effect = new_connection
+        self.source['__consistentSnapshot'] = True
+        self.source['__concurrency'] = 2
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.table1'}, {'value': 'public.table2'}]
+        inst.state = mock.Mock()
+
+        rows = 0
+        result = inst.read()
+        while result is not None:
+            rows += len(result)
+            result = inst.read()
+
+        self.assertEqual(rows, 6)
+        coordinator.cursor.return_value.execute.assert_called_once_with(
+            SQL_EXPORT_SNAPSHOT)
+        self.assertEqual(len(readers), 2)
+        for conn in readers:
+            first = conn.cursor.return_value.execute.call_args_list[0]
+            self.assertEqual(first, mock.call(SQL_SET_SNAPSHOT,
+                                              ['00000003-0000001B-1']))
+        coordinator.close.assert_called_once_with()
+        self.assertIsNone(inst.snapshot)
+
+        with self.assertRaises(PostgresValidationError):
+            Postgres(dict(self.source, __engine='keyset'), OPTIONS)
+
+    @mock.patch("postgresv2.postgresv2.CONNECT_TIMEOUT", 0)
+    @mock.patch("psycopg2.connect")
+    def test_consistent_snapshot_lost(self, mock_connect):
+        """a snapshot which is gone fails the read right away, rather than
+        retrying it in the same snapshot"""
+        coordinator, reader = mock.MagicMock(), mock.MagicMock()
+        coordinator.cursor.return_value.fetchall.return_value = [
+            {'snapshot': '00000003-0000001B-1'}]
+        reader.cursor.return_value.execute.side_effect = \
+            psycopg2.errors.InvalidParameterValue(
+                'invalid snapshot identifier')
+        mock_connect.side_effect = [coordinator, reader]
+        self.source['__consistentSnapshot'] = True
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.table1'}]
+
+        with self.assertRaises(PostgresValidationError):
+            inst.read()
+
+        self.assertEqual(mock_connect.call_count, 2)
+        reader.close.assert_called_once_with()
+        coordinator.close.assert_called_once_with()
+        self.assertIsNone(inst.snapshot)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_read_parallel_skips_completed(self, mock_connect, _):
+        """resuming a parallel read skips the tables that were completed"""
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [self.mock_recs, []]
+        self.source['__concurrency'] = 4
+        self.source['state'] = {'last_index': 0, 'completed': [1, 2]}
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [
+            {'value': 'public.table1'},
+            {'value': 'public.table2'},
+            {'value': 'public.table3'},
+        ]
+
+        result = inst.read()
+        self.assertEqual(result[0]['__tablename'], 'table1')
+        self.assertEqual(inst.read(), [])
+        self.assertEqual(inst.index, 3)
+        self.assertIsNone(inst.read())
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("postgresv2.postgresv2.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_read_split_table(self, mock_connect, mock_state, _):
+        """a table is split into primary key ranges read concurrently"""
+        connections = []
+
+        def new_connection(*args, **kwargs):
+            conn = mock.MagicMock()
+            fetchall = conn.cursor.return_value.fetchall
+            if not connections:
+                # the first connection looks up the bounds of the table
+                conn.cursor.return_value.description = [('id',), ('col1',)]
+                fetchall.side_effect = [[{'min': 1, 'max': 100}]]
+            else:
+                fetchall.side_effect = [[dict(r) for r in self.mock_recs],
+                                        []]
+            connections.append(conn)
+            return conn
+
+        mock_connect.side_effect = new_connection
+        self.source['__concurrency'] = 2
+        self.source['__splitMode'] = 'pk'
+        self.source['idpattern'] = '{id}'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'public.table1'}]
+
+        results = []
+        result = inst.read()
+        while result is not None:
+            results.append(result)
+            result = inst.read()
+
+        rows = [row for batch in results for row in batch]
+        self.assertEqual(len(rows), 2 * len(self.mock_recs))
+        # a single table completion, after both ranges were read
+        self.assertEqual(results.count([]), 2)
+        self.assertEqual(inst.index, 1)
+
+        declares = [c[0][0] for conn in connections[1:]
+                    for c in conn.cursor.return_value.execute.call_args_list
+                    if c[0][0].startswith('DECLARE')]
+        self.assertEqual(sorted(declares), [
+            'DECLARE cur CURSOR FOR SELECT * FROM "public"."table1" '
+            'WHERE ("inckey" >= \'incval\' AND "inckey" <= \'100\') '
+            'AND "id" >= \'51\' ORDER BY "inckey"',
+            'DECLARE cur CURSOR FOR SELECT * FROM "public"."table1" '
+            'WHERE ("inckey" >= \'incval\' AND "inckey" <= \'100\') '
+            'AND ("id" < \'51\' OR "id" IS NULL) ORDER BY "inckey"',
+        ])
+
+    def test_split_validation(self):
+        """splitting by the incremental key requires one, and no table is
+        split without concurrency"""
+        self.source['inckey'] = ''
+        self.source['__splitMode'] = 'inckey'
+        with self.assertRaises(PostgresValidationError):
+            Postgres(dict(self.source, __concurrency=2), OPTIONS)
+
+        logger = mock.Mock()
+        Postgres(dict(self.source, __splitMode='pk'), dict(logger=logger))
+        self.assertIn('__concurrency', logger.call_args[0][0])
+
+    def test_split_ranges(self):
+        self.assertEqual(get_split_bounds(1, 100, 4), [26, 51, 76])
+        self.assertEqual(get_split_bounds(1, 2, 4), [2])
+        self.assertIsNone(get_split_bounds(5, 5, 4))
+        self.assertIsNone(get_split_bounds('a', 'z', 4))
+
+        expected = [
+            '("id" < \'26\' OR "id" IS NULL)',
+            '("id" >= \'26\' AND "id" < \'51\')',
+            '"id" >= \'51\''
+        ]
+        self.assertEqual(get_key_ranges('id', [26, 51]), expected)
+
+        expected = [
+            "ctid < '(3,0)'::tid",
+            "(ctid >= '(3,0)'::tid AND ctid < '(6,0)'::tid)",
+            "ctid >= '(6,0)'::tid"
+        ]
+        self.assertEqual(get_ctid_ranges(10, 3), expected)
+
+    def test_get_query_with_where(self):
+        result = get_query('public', 'test', '', '', None, where='x > 1')
+        expected = 'SELECT * FROM "public"."test" WHERE x > 1'
+
+        self.assertEqual(result, expected)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_read_copy_engine(self, mock_connect, _):
+        """reads a table with COPY TO STDOUT into the same rows as the cursor
+        engine (with text values)"""
+
+        def copy_expert(sql, file):
+            file.write(b'1\tfoo1\tbar1\n')
+            file.write(b'2\tfoo2\t\\N\n3\tfoo\\t3\tbar3\n')
+
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [('id',), ('col1',), ('col2',)]
+        cursor.copy_expert.side_effect = copy_expert
+        self.source['__engine'] = 'copy'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+        rows = inst.read(2)
+        self.assertEqual(rows, [
+            dict(id='1', col1='foo1', col2='bar1', __tablename='foo_bar',
+                 __schemaname='my_schema', __databasename='foobar',
+                 __state=inst.state_id),
+            dict(id='2', col1='foo2', col2=None, __tablename='foo_bar',
+                 __schemaname='my_schema', __databasename='foobar',
+                 __state=inst.state_id),
+        ])
+        rows = inst.read(2)
+        self.assertEqual(rows[0]['col1'], 'foo\t3')
+        self.assertEqual(inst.read(2), [])
+        self.assertIsNone(inst.read(2))
+
+        q = ('COPY (SELECT * FROM "my_schema"."foo_bar" WHERE '
+             '("inckey" >= \'incval\' AND "inckey" <= \'100\') '
+             'ORDER BY "inckey") TO STDOUT')
+        self.assertEqual(cursor.copy_expert.call_args[0][0], q)
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_read_tuple_rows(self, mock_connect, _):
+        """the tuple row format returns a batch of tuples with a single header
+        which still reads as a list of dicts"""
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [('id',), ('col1',), ('col2',)]
+        cursor.fetchall.side_effect = [
+            [tuple(r.values()) for r in self.mock_recs], []
+        ]
+        self.source['__rowFormat'] = 'tuple'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+        rows = inst.read()
+        self.assertIsInstance(rows, Batch)
+        self.assertEqual(rows.columns, ['id', 'col1', 'col2'])
+        self.assertEqual(rows.rows[0], (1, 'foo1', 'bar1'))
+        self.assertEqual(rows.internals['__tablename'], 'foo_bar')
+        expected = [dict(r, __tablename='foo_bar', __schemaname='my_schema',
+                         __databasename='foobar', __state=inst.state_id)
+                    for r in self.mock_recs]
+        self.assertEqual(rows, expected)
+        self.assertEqual(rows[1:].to_dicts(), expected[1:])
+        self.assertEqual(inst.read(), [])
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.extensions.register_type")
+    @mock.patch("psycopg2.connect")
+    def test_parse_json(self, mock_connect, mock_register, _):
+        """JSON columns are kept as text, and the string fields among them
+        are parsed once a batch is accessed"""
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [('id',), ('doc',), ('raw',)]
+        recs = [(1, '{"a": [1, 2]}', '{"b": 1}'), (2, 'not json', None),
+                (3, None, '[]')]
+        cursor.fetchall.side_effect = [list(recs), []]
+        self.source.update(__parseJson=True, stringFields='doc, other',
+                           __rowFormat='tuple')
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+        rows = inst.read()
+        registered = [c[0][0] for c in mock_register.call_args_list]
+        self.assertEqual(registered, [JSON_RAW, JSON_RAW_ARRAY])
+        self.assertEqual(rows._rows, recs)  # not parsed until accessed
+        self.assertEqual([(r['doc'], r['raw']) for r in rows], [
+            ({'a': [1, 2]}, '{"b": 1}'), ('not json', None), (None, '[]')])
+
+        # rows as dicts are parsed right away
+        cursor.fetchall.side_effect = [
+            [dict(zip(['id', 'doc', 'raw'], r)) for r in recs], []]
+        self.source['__rowFormat'] = 'dict'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        self.assertEqual([r['doc'] for r in inst.read()],
+                         [{'a': [1, 2]}, 'not json', None])
+
+    @mock.patch.object(Postgres, 'get_max_value', side_effect=mock_max_value)
+    @mock.patch("psycopg2.connect")
+    def test_read_columnar(self, mock_connect, _):
+        """batches are returned as column arrays with a schema header, and
+        still read as a list of dicts"""
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [('id', 23), ('name', 25), ('ratio', 701),
+                              ('big', 20)]
+        recs = [(1, 'foo', 0.5, 10), (2, 'bar', 1.5, None)]
+        cursor.fetchall.side_effect = [recs, []]
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+        batch = inst.read_columnar()
+        self.assertIsInstance(batch, ColumnBatch)
+        self.assertEqual(batch.schema, cursor.description)
+        self.assertEqual(batch.columns, [array('i', [1, 2]), ['foo', 'bar'],
+                                         array('d', [0.5, 1.5]), [10, None]])
+        self.assertEqual(batch.internals['__state'], inst.state_id)
+        internals = batch.internals
+        self.assertEqual(batch, [dict(zip(['id', 'name', 'ratio', 'big'], r),
+                                      **internals) for r in recs])
+        self.assertEqual(batch[1:][0]['name'], 'bar')
+        self.assertEqual(len(inst.read_columnar()), 0)
+        self.assertEqual(inst.index, 1)
+
+    def test_parse_copy_line(self):
+        line = 'a\t\\N\t\\\\N\tb\\nc\t\\x41\\101\t'
+        self.assertEqual(parse_line(line),
+                         ['a', None, '\\N', 'b\nc', 'AA', ''])
+
+    def test_binary_copy_decoder(self):
+        """decodes the rows of a binary COPY, written in arbitrary chunks"""
+
+        def field(fmt, *values):
+            data = struct.pack(fmt, *values)
+            return struct.pack('>i', len(data)) + data
+
+        # int4, numeric, text, timestamp, date, bool
+        types = [23, 1700, 25, 1114, 1082, 16]
+        data = SIGNATURE + struct.pack('>ii', 0, 0)
+        data += struct.pack('>h', 6)
+        data += field('>i', 1)
+        # -12345.6700 = -(1 * 10000 + 2345 + 6700 / 10000), scale of 4
+        data += field('>hhHhhhh', 3, 1, 0x4000, 4, 1, 2345, 6700)
+        data += field('>3s', b'foo')
+        data += field('>q', 86400 * 1000000 + 5)
+        data += field('>i', -1)
+        data += field('>?', True)
+        data += struct.pack('>h', 6) + struct.pack('>i', -1) * 6
+        data += struct.pack('>h', -1)
+
+        reader = BinaryCopyReader(mock.MagicMock(), 'SELECT 1', list('abcdef'),
+                                  types, 10)
+        rows = []
+        for i in range(0, len(data), 7):
+            rows.extend(reader.parse(data[i:i + 7]))
+
+        self.assertEqual(rows, [
+            [1, Decimal('-12345.6700'), 'foo',
+             datetime.datetime(2000, 1, 2, 0, 0, 0, 5),
+             datetime.date(1999, 12, 31), True],
+            [None] * 6
+        ])
+        self.assertEqual(str(rows[0][1]), '-12345.6700')
+        self.assertTrue(reader.done)
+
+        # 0.000001 = 100 * 10000 ^ -2, scale of 6
+        value = decode_numeric(struct.pack('>hhHhh', 1, -2, 0, 6, 100), 0, 10)
+        self.assertEqual(str(value), '0.000001')
+
+    def test_binary_copy_values(self):
+        """decodes text in the client encoding, bytea as memoryviews and
+        timestamptz in the session time zone, as the cursor engine does"""
+        connector = mock.MagicMock()
+        connector.connection.encoding = 'LATIN1'
+        connector.connection.info.parameter_status.return_value = 'UTC'
+        types = [25, 17, 1184]
+        data = SIGNATURE + struct.pack('>iih', 0, 0, 3)
+        for value in ('café'.encode('latin-1'), b'\x00\xff',
+                      struct.pack('>q', 86400 * 1000000)):
+            data += struct.pack('>i', len(value)) + value
+        data += struct.pack('>h', -1)
+
+        reader = BinaryCopyReader(connector, 'SELECT 1', list('abc'), types,
+                                  10)
+        self.assertEqual(reader.query, 'SELECT 1')
+        text, blob, timestamp = reader.parse(data)[0]
+        self.assertEqual(text, 'café')
+        self.assertIsInstance(blob, memoryview)
+        self.assertEqual(blob.tobytes(), b'\x00\xff')
+        self.assertEqual(timestamp, datetime.datetime(
+            2000, 1, 2, tzinfo=datetime.timezone.utc))
+
+        # in other time zones timestamptz values are converted from text
+        connector.connection.info.parameter_status.return_value = \
+            'Europe/Berlin'
+        reader = BinaryCopyReader(connector, 'SELECT 1', list('abc'), types,
+                                  10)
+        self.assertEqual(reader.query, 'SELECT "a", "b", "c"::text FROM '
+                                       '(SELECT 1) AS q')
+        value = b'2000-01-02 01:00:00+01'
+        data = SIGNATURE + struct.pack('>iih', 0, 0, 3)
+        data += struct.pack('>ii', -1, -1)
+        data += struct.pack('>i', len(value)) + value
+        with mock.patch('psycopg2.extensions.PYDATETIMETZ') as cast:
+            row = reader.parse(data + struct.pack('>h', -1))[0]
+        self.assertEqual(row[2], cast.return_value)
+        cast.assert_called_once_with('2000-01-02 01:00:00+01',
+                                     connector.cursor)
+
+    def test_binary_query_casts_unknown_types(self):
+        query = get_binary_query('SELECT * FROM t', ['a', 'b'], [23, 25])
+        self.assertEqual(query, 'SELECT * FROM t')
+
+        # interval (1186) has no decoder
+        query = get_binary_query('SELECT * FROM t', ['a', 'b'], [23, 1186])
+        self.assertEqual(query,
+                         'SELECT "a", "b"::text FROM (SELECT * FROM t) AS q')
+
+    def test_get_query_with_columns(self):
+        result = get_query('public', 'test', '', '', None,
+                           columns=['id', 'we"ird'])
+        expected = 'SELECT "id", "we""ird" FROM "public"."test"'
+
+        self.assertEqual(result, expected)
+
     def test_get_query_without_incremental(self):
         inckey = ''
         incval = ''